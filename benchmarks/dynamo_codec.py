@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import time
+import typing
+
+# Compares decoding and encoding Birthdays table items with src/dynamo_codec.py against the generic boto3
+# (de)serializer path it replaced, which also round-tripped every date through "dd/mm/yyyy" strings.
+#
+#   python benchmarks/dynamo_codec.py --items 100000
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from src import dynamo_codec, utils
+from src.birthday_storage import Birthday
+
+
+def generic_birthday_from_item(item: dict) -> Birthday:
+    item = utils.dynamo_obj_to_python_obj(item)
+    date_str = "/".join([
+        str(item[k]) for k in ['birthday_day', 'birthday_month', 'birthday_year']
+        if k in item and item[k] is not None
+    ])
+    return Birthday(item['name'], date_str)
+
+
+def generic_birthday_to_item(chat_id: str, birthday: Birthday) -> dict:
+    return utils.python_obj_to_dynamo_obj({
+        'chat_id': chat_id,
+        'name': birthday.name,
+        'birthday_day': int(birthday.day),
+        'birthday_month': int(birthday.month),
+        'birthday_year': int(birthday.year) if birthday.year is not None else None,
+        'birthday_mmdd': utils.mmdd(birthday.month, birthday.day),
+    })
+
+
+def synthetic_birthdays(count: int) -> typing.List[Birthday]:
+    birthdays = []
+    for i in range(count):
+        year = 1950 + i % 60 if i % 3 else None
+        birthdays.append(Birthday.from_parts("Person {}".format(i), 1 + i % 28, 1 + i % 12, year))
+    return birthdays
+
+
+def timed(label: str, function: typing.Callable[[], list], baseline: typing.Optional[float] = None) -> float:
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+    speedup = " ({:.1f}x)".format(baseline / elapsed) if baseline is not None else ""
+    print("  {:<8} {:>8.1f} ms{}".format(label, elapsed * 1000, speedup))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DynamoDB item codec microbenchmark")
+    parser.add_argument("--items", type=int, default=100_000)
+    args = parser.parse_args()
+
+    birthdays = synthetic_birthdays(args.items)
+    items = [generic_birthday_to_item("1", birthday) for birthday in birthdays]
+    assert items == [dynamo_codec.birthday_to_item("1", birthday) for birthday in birthdays]
+    assert [dynamo_codec.birthday_from_item(item) for item in items] == [
+        generic_birthday_from_item(item) for item in items
+    ]
+
+    print("decode {} items".format(args.items))
+    baseline = timed("generic", lambda: [generic_birthday_from_item(item) for item in items])
+    timed("codec", lambda: [dynamo_codec.birthday_from_item(item) for item in items], baseline)
+    print("encode {} items".format(args.items))
+    baseline = timed("generic", lambda: [generic_birthday_to_item("1", birthday) for birthday in birthdays])
+    timed("codec", lambda: [dynamo_codec.birthday_to_item("1", birthday) for birthday in birthdays], baseline)
+
+
+if __name__ == '__main__':
+    main()
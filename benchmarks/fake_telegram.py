@@ -0,0 +1,127 @@
+import collections
+import itertools
+import json
+import threading
+import time
+import typing
+
+from http import server
+from urllib import parse
+
+# A local stand-in for the Telegram Bot API, enough for the bot's outbound calls. Point the bot at it with
+# TELEGRAM_API_URL=FakeTelegramServer.url before importing src.bot. Every call is answered successfully
+# and counted by method. getUpdates serves the updates queued with add_updates, long polling like Telegram
+# does, and drops them once a later call confirms them with its offset. `latency` delays every other answer,
+# like the round trip to the real Bot API would.
+
+
+class _HTTPServer(server.ThreadingHTTPServer):
+    # The default backlog of 5 drops connections from concurrent workers, which then wait for a SYN resend
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeTelegramServer:
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.latency = latency
+        self.calls: typing.Counter[str] = collections.Counter()
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.pending_updates: typing.List[dict] = []
+        self.updates_added = threading.Condition(self.lock)
+        self.httpd = _HTTPServer((host, port), self._handler_class())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self) -> 'FakeTelegramServer':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def total_calls(self) -> int:
+        with self.lock:
+            return sum(self.calls.values())
+
+    def add_updates(self, updates: typing.Iterable[dict]) -> int:
+        # Assigns the update ids and returns the last one
+        update_id = 0
+        with self.lock:
+            for update in updates:
+                update_id = next(self.update_ids)
+                self.pending_updates.append({**update, "update_id": update_id})
+            self.updates_added.notify_all()
+        return update_id
+
+    def pending(self) -> int:
+        # Updates not confirmed yet
+        with self.lock:
+            return len(self.pending_updates)
+
+    def _get_updates(self, params: typing.Dict[str, str]) -> typing.List[dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        with self.lock:
+            self.pending_updates = [update for update in self.pending_updates if update["update_id"] >= offset]
+            timeout = float(params.get("timeout") or 0)
+            self.updates_added.wait_for(lambda: len(self.pending_updates) > 0, timeout=timeout)
+            return self.pending_updates[:limit]
+
+    def _record(self, method: str, params: typing.Dict[str, str]) -> typing.Any:
+        with self.lock:
+            self.calls[method] += 1
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+        if method in ("sendMessage", "sendDocument"):
+            message = {
+                "message_id": next(self.message_ids),
+                "date": 0,
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            }
+            if "text" in params:
+                message["text"] = params["text"]
+            return message
+        return True
+
+    def _handler_class(self) -> typing.Type[server.BaseHTTPRequestHandler]:
+        fake = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self._answer()
+
+            def do_POST(self):
+                self._answer()
+
+            def _answer(self):
+                # Paths are /bot{token}/{method}; parameters come in the query string or a form body
+                url = parse.urlsplit(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = dict(parse.parse_qsl(url.query))
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update(parse.parse_qsl(body.decode("utf-8")))
+                response = json.dumps({"ok": True, "result": fake._record(method, params)}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
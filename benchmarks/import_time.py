@@ -0,0 +1,85 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import typing
+
+# Measures the cold-start import cost of the entry modules with `python -X importtime`, each one in a fresh
+# interpreter. Exits with 1 when an entry module takes longer than --max-ms, so it can gate changes:
+#
+#   python benchmarks/import_time.py --max-ms 400
+#   python benchmarks/import_time.py lambda.remind --top 20
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_MODULES = ["lambda.remind", "lambda.webhook", "src.reminders", "src.handlers"]
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+class ImportTime(typing.NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def measure(module: str) -> typing.List[ImportTime]:
+    # importlib is needed because `lambda` is a keyword
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import importlib; importlib.import_module({!r})".format(module)],
+        cwd=parent_dir,
+        # The bot is built at import time and needs a token, a dummy one is enough as nothing is sent
+        env={**os.environ, 'TOKEN': '1:import'},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError("Could not import {}:\n{}".format(module, result.stderr.strip().splitlines()[-1]))
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is not None:
+            self_us, cumulative_us, indent, name = match.groups()
+            times.append(ImportTime(name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return times
+
+
+def total_ms(times: typing.List[ImportTime]) -> float:
+    # Top level imports include the time of everything they import
+    return sum(time.cumulative_us for time in times if time.depth == 0) / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the entry modules")
+    parser.add_argument("modules", nargs="*", default=ENTRY_MODULES)
+    parser.add_argument("--max-ms", type=float, default=None, help="fail when a module takes longer to import")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to show per module")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per module, the fastest one is reported")
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules:
+        try:
+            runs = [measure(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(e)
+            failed.append(module)
+            continue
+        times = min(runs, key=total_ms)
+        loaded = {time.module for time in times}
+        print("{}: {:.1f} ms, {} modules".format(module, total_ms(times), len(loaded)))
+        for time in sorted(times, key=lambda time: time.cumulative_us, reverse=True)[:args.top]:
+            print("  {:>9.1f} ms  {}".format(time.cumulative_us / 1000, time.module))
+        heavy = sorted(name for name in ("boto3", "botocore", "redis", "telebot") if name in loaded)
+        print("  heavy dependencies: {}".format(", ".join(heavy) if len(heavy) > 0 else "none"))
+        if args.max_ms is not None and total_ms(times) > args.max_ms:
+            print("  over the {:.0f} ms budget".format(args.max_ms))
+            failed.append(module)
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
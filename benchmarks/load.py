@@ -0,0 +1,429 @@
+import argparse
+import collections
+import datetime
+import importlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import typing
+
+# Load harness for the webhook and reminder paths. Synthetic updates are fed to the Lambda webhook handler
+# and then an hourly reminder run is timed, against a local fake Bot API server and local storage
+# stand-ins: fakeredis (or a local Redis with --redis-url) and moto for DynamoDB. Nothing leaves the
+# machine, so it can gate changes in CI:
+#
+#   python benchmarks/load.py --storage Redis --users 500 --birthdays 50 --updates 5000 --max-p99-ms 20
+#
+# Reported per command: latency percentiles, storage method calls, backend round trips (Redis commands
+# or pipelines, DynamoDB API calls) and Bot API calls, plus throughput and the peak traced memory. With
+# --plan the day's reminders are planned first, and the reminder run reads its slot of the plan. With
+# --shards the reminder run is timed again with each shard count, against the single process run:
+#
+#   python benchmarks/load.py --storage Redis --users 2000 --shards 2,4,8 --api-latency-ms 20
+#
+# The shards are forked from the harness, so with fakeredis and moto they read a copy of its data. The
+# Memory storage can't be sharded.
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from fake_telegram import FakeTelegramServer
+
+DEFAULT_MIX = "add=4,get=3,list=2,listupcoming=2,delete=1,setreminderhour=1"
+
+
+def parse_mix(mix: str) -> typing.Dict[str, int]:
+    weights = {}
+    for entry in mix.split(","):
+        command, _, weight = entry.partition("=")
+        weights[command.strip()] = int(weight or 1)
+    return weights
+
+
+def percentile(values: typing.List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+class CallCounter:
+    # Counts storage method calls through proxies, and backend round trips through client hooks
+
+    def __init__(self):
+        self.storage = 0
+        self.backend = 0
+
+    def proxy(self, target: typing.Any) -> typing.Any:
+        counter = self
+
+        class CountingProxy:
+            def __getattr__(self, name):
+                attribute = getattr(target, name)
+                if not callable(attribute) or name.startswith("_"):
+                    return attribute
+
+                def call(*args, **kwargs):
+                    counter.storage += 1
+                    return attribute(*args, **kwargs)
+                return call
+
+        return CountingProxy()
+
+    def count_backend(self, *args, **kwargs):
+        self.backend += 1
+
+
+def setup_redis(args: argparse.Namespace, counter: CallCounter):
+    import redis
+    from src import redis_client
+
+    if args.redis_url:
+        client = redis.Redis.from_url(args.redis_url)
+        client.flushdb()
+    else:
+        import fakeredis
+        client = fakeredis.FakeRedis()
+    # Commands and pipelines are both a single packed write per round trip
+    send_packed_command = redis.connection.Connection.send_packed_command
+
+    def counting_send_packed_command(connection, *command_args, **command_kwargs):
+        counter.count_backend()
+        return send_packed_command(connection, *command_args, **command_kwargs)
+
+    redis.connection.Connection.send_packed_command = counting_send_packed_command
+    redis_client.get_client = lambda: client
+
+
+def setup_dynamodb(counter: CallCounter):
+    import boto3
+    import moto
+
+    moto.mock_aws().start()
+    client = boto3.client('dynamodb', region_name='sa-east-1')
+
+    def index(name: str, hash_key: str, range_key: typing.Optional[str] = None) -> dict:
+        key_schema = [{'AttributeName': hash_key, 'KeyType': 'HASH'}]
+        if range_key is not None:
+            key_schema.append({'AttributeName': range_key, 'KeyType': 'RANGE'})
+        return {'IndexName': name, 'KeySchema': key_schema, 'Projection': {'ProjectionType': 'ALL'}}
+
+    # Mirrors the tables in serverless.yml
+    client.create_table(
+        TableName=os.environ['BIRTHDAYS_TABLE_NAME'],
+        AttributeDefinitions=[
+            {'AttributeName': name, 'AttributeType': attribute_type} for name, attribute_type in [
+                ('chat_id', 'S'), ('name', 'S'),
+                ('birthday_day', 'N'), ('birthday_month', 'N'), ('birthday_mmdd', 'N'),
+            ]
+        ],
+        KeySchema=[{'AttributeName': 'chat_id', 'KeyType': 'HASH'}, {'AttributeName': 'name', 'KeyType': 'RANGE'}],
+        GlobalSecondaryIndexes=[
+            index('BirthdayIndex', 'birthday_month', 'birthday_day'),
+            index('UserBirthdaysIndex', 'chat_id', 'birthday_month'),
+            index('UpcomingBirthdaysIndex', 'chat_id', 'birthday_mmdd'),
+        ],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    client.create_table(
+        TableName=os.environ['USERS_TABLE_NAME'],
+        AttributeDefinitions=[{'AttributeName': 'chat_id', 'AttributeType': 'S'},
+                              {'AttributeName': 'reminder_hour', 'AttributeType': 'N'}],
+        KeySchema=[{'AttributeName': 'chat_id', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[index('ReminderHourIndex', 'reminder_hour')],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    client.create_table(
+        TableName=os.environ['REMINDER_STATE_TABLE_NAME'],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+
+    from src import dynamodb_client
+    dynamodb_client.get_client().meta.events.register('before-call.dynamodb', counter.count_backend)
+
+
+def reset_reminder_state(args: argparse.Namespace):
+    # Drops the delivered markers and checkpoints of the previous reminder runs, plans are kept: each timed
+    # run delivers the same reminders
+    if args.storage == "Redis":
+        from src import redis_client
+        client = redis_client.get_client()
+        for pattern in ("reminder:*", "checkpoint:*"):
+            keys = list(client.scan_iter(match=pattern))
+            if len(keys) > 0:
+                client.delete(*keys)
+    elif args.storage == "DynamoDB":
+        from src import dynamodb_client
+        client = dynamodb_client.get_client()
+        table_name = os.environ['REMINDER_STATE_TABLE_NAME']
+        for page in client.get_paginator('scan').paginate(TableName=table_name, ProjectionExpression='id'):
+            for item in page['Items']:
+                if not item['id']['S'].startswith('plan#'):
+                    client.delete_item(TableName=table_name, Key={'id': item['id']})
+
+
+def start_environment(args: argparse.Namespace, api_latency: float = 0.0
+                      ) -> typing.Tuple[FakeTelegramServer, CallCounter]:
+    # Starts the fake Bot API and points the bot and the storages at local stand-ins, before src is imported
+    telegram = FakeTelegramServer(latency=api_latency).start()
+    os.environ.update({
+        'TOKEN': '1:load',
+        'TELEGRAM_API_URL': telegram.url,
+        'STORAGE_TYPE': args.storage,
+        'BIRTHDAYS_TABLE_NAME': 'birthdays',
+        'USERS_TABLE_NAME': 'users',
+        'REMINDER_STATE_TABLE_NAME': 'reminder_state',
+        'AWS_ACCESS_KEY_ID': 'load',
+        'AWS_SECRET_ACCESS_KEY': 'load',
+        'AWS_DEFAULT_REGION': 'sa-east-1',
+        # The fake Bot API has no flood limits
+        'DELIVERY_GLOBAL_RATE': '1000000',
+        'DELIVERY_CHAT_RATE': '1000000',
+    })
+
+    counter = CallCounter()
+    if args.storage == "Redis":
+        setup_redis(args, counter)
+    elif args.storage == "DynamoDB":
+        setup_dynamodb(counter)
+    return telegram, counter
+
+
+def seed_storages(args: argparse.Namespace, rng: random.Random, now: datetime.datetime
+                  ) -> typing.Tuple[typing.List[str], typing.Dict[str, typing.List[str]]]:
+    # Stores the users and their birthdays, returns the chat ids and the names each chat has
+    from src import services
+    from src.birthday_storage import Birthday
+    from src.user_storage import User
+
+    chat_ids = [str(1000 + i) for i in range(args.users)]
+    names: typing.Dict[str, typing.List[str]] = {}
+    for chat_id in chat_ids:
+        services.user_storage().store_user(User(chat_id, "user", "User", None, now.hour))
+        birthdays = []
+        for i in range(args.birthdays):
+            day, month = (now.day, now.month) if rng.random() < args.today else random_date(rng)
+            birthdays.append(Birthday.from_parts("Person {}".format(i), day, month, rng.choice([None, 1990])))
+        services.birthday_storage().store_birthdays_bulk(chat_id, birthdays)
+        names[chat_id] = [birthday.name for birthday in birthdays]
+    return chat_ids, names
+
+
+def random_date(rng: random.Random) -> typing.Tuple[int, int]:
+    month = rng.randint(1, 12)
+    return rng.randint(1, 28), month
+
+
+class UpdateStream:
+    # Synthetic updates following the command mix, against the names each chat is known to have
+
+    def __init__(self, rng: random.Random, chat_ids: typing.List[str], names: typing.Dict[str, typing.List[str]],
+                 mix: typing.Dict[str, int]):
+        self.rng = rng
+        self.chat_ids = chat_ids
+        self.names = names
+        self.commands = list(mix)
+        self.weights = [mix[command] for command in self.commands]
+        self.update_ids = iter(range(1, 1 << 62))
+        self.added = 0
+
+    def next(self) -> typing.Tuple[str, dict]:
+        chat_id = self.rng.choice(self.chat_ids)
+        command = self.rng.choices(self.commands, self.weights)[0]
+        names = self.names[chat_id]
+        if command == "add":
+            self.added += 1
+            name = "Added {}".format(self.added)
+            names.append(name)
+            text = "/add {} {}/{}".format(name, *random_date(self.rng))
+        elif command in ("get", "delete") and len(names) > 0:
+            name = self.rng.choice(names)
+            if command == "delete":
+                names.remove(name)
+            text = "/{} {}".format(command, name)
+        elif command == "listupcoming":
+            text = "/listupcoming 30"
+        elif command == "setreminderhour":
+            text = "/setreminderhour {}".format(self.rng.randint(0, 23))
+        else:
+            text = "/{}".format(command)
+        return command, self.message_update(chat_id, text)
+
+    def message_update(self, chat_id: str, text: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"},
+                "from": {"id": int(chat_id), "is_bot": False, "first_name": "User", "username": "user"},
+                "text": text,
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook and reminder load harness")
+    parser.add_argument("--storage", choices=["Memory", "Redis", "DynamoDB"], default="Memory")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--birthdays", type=int, default=20, help="birthdays stored per user before the run")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="command=weight pairs")
+    parser.add_argument("--today", type=float, default=0.05, help="share of the birthdays that fall today")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redis-url", default=None, help="use this Redis (it is flushed) instead of fakeredis")
+    parser.add_argument("--plan", action="store_true",
+                        help="plan the day before the updates, which then patch the plan the reminder run reads")
+    parser.add_argument("--shards", default="1",
+                        help="comma separated shard counts to time the reminder run with (Redis or DynamoDB)")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="delay of the fake Bot API answers")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows the run")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="fail when a command's p99 is higher")
+    args = parser.parse_args()
+    shard_counts = [int(shards) for shards in args.shards.split(",") if int(shards) > 1]
+    if args.storage == "Memory" and len(shard_counts) > 0:
+        parser.error("the Memory storage can't be sharded, its data lives in the harness process")
+
+    telegram, counter = start_environment(args, api_latency=args.api_latency_ms / 1000)
+
+    from src import services
+    from src.reminders import plan, reminder
+    webhook = importlib.import_module('lambda.webhook').handler
+
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    chat_ids, names = seed_storages(args, rng, now)
+
+    birthday_storage, user_storage = services.birthday_storage(), services.user_storage()
+    reminder_state_storage = services.reminder_state_storage()
+    services.birthday_storage = lambda: counter.proxy(birthday_storage)
+    services.user_storage = lambda: counter.proxy(user_storage)
+    services.reminder_state_storage = lambda: counter.proxy(reminder_state_storage)
+
+    planner = None
+    if args.plan:
+        storage_calls, backend_calls = counter.storage, counter.backend
+        plan_started = time.perf_counter()
+        planned = plan(now.date())
+        planner = {
+            'ms': (time.perf_counter() - plan_started) * 1000,
+            'planned': planned,
+            'storage_calls': counter.storage - storage_calls,
+            'backend_calls': counter.backend - backend_calls,
+        }
+
+    stream = UpdateStream(rng, chat_ids, names, parse_mix(args.mix))
+    latencies: typing.Dict[str, typing.List[float]] = collections.defaultdict(list)
+    calls: typing.Dict[str, typing.Counter[str]] = collections.defaultdict(collections.Counter)
+    if not args.no_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(args.updates):
+        command, update = stream.next()
+        storage_calls, backend_calls, telegram_calls = counter.storage, counter.backend, telegram.total_calls()
+        update_started = time.perf_counter()
+        webhook({'body': json.dumps(update)}, None)
+        latencies[command].append((time.perf_counter() - update_started) * 1000)
+        calls[command].update({
+            'storage': counter.storage - storage_calls,
+            'backend': counter.backend - backend_calls,
+            'telegram': telegram.total_calls() - telegram_calls,
+        })
+    elapsed = time.perf_counter() - started
+
+    storage_calls, backend_calls, telegram_calls = counter.storage, counter.backend, telegram.total_calls()
+    reminder_started = time.perf_counter()
+    summary = reminder(now=now, shards=1)
+    reminder_ms = (time.perf_counter() - reminder_started) * 1000
+    peak_bytes = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    tracemalloc.stop()
+
+    sharded = []
+    for shards in shard_counts:
+        reset_reminder_state(args)
+        telegram_calls = telegram.total_calls()
+        shards_started = time.perf_counter()
+        shards_summary = reminder(now=now, shards=shards)
+        shards_ms = (time.perf_counter() - shards_started) * 1000
+        sharded.append({
+            'shards': shards,
+            'ms': shards_ms,
+            'sent': shards_summary.sent,
+            'failed': shards_summary.failed,
+            'telegram_calls': telegram.total_calls() - telegram_calls,
+            'speedup': reminder_ms / shards_ms,
+        })
+    telegram.stop()
+
+    report = {
+        'storage': args.storage,
+        'users': args.users,
+        'birthdays_per_user': args.birthdays,
+        'updates': args.updates,
+        'throughput_per_second': args.updates / elapsed,
+        'commands': {
+            command: {
+                'count': len(values),
+                'p50_ms': percentile(values, 0.5),
+                'p99_ms': percentile(values, 0.99),
+                'mean_ms': statistics.fmean(values),
+                **{
+                    name + '_calls_per_op': calls[command][name] / len(values)
+                    for name in ('storage', 'backend', 'telegram')
+                },
+            }
+            for command, values in sorted(latencies.items())
+        },
+        'reminder': {
+            'ms': reminder_ms,
+            'sent': summary.sent,
+            'failed': summary.failed,
+            'storage_calls': counter.storage - storage_calls,
+            'backend_calls': counter.backend - backend_calls,
+            'telegram_calls': telegram.total_calls() - telegram_calls,
+        },
+        'sharded_reminders': sharded,
+        'planner': planner,
+        'peak_memory_bytes': peak_bytes,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.max_p99_ms is not None:
+        slow = [command for command, stats in report['commands'].items() if stats['p99_ms'] > args.max_p99_ms]
+        if len(slow) > 0:
+            print("p99 over {} ms: {}".format(args.max_p99_ms, ", ".join(slow)))
+            sys.exit(1)
+
+
+def print_report(report: dict):
+    print("{storage} storage, {users} users, {birthdays_per_user} birthdays per user, {updates} updates".format(
+        **report))
+    print("{:<16}{:>7}{:>9}{:>9}{:>10}{:>10}{:>10}".format(
+        "command", "count", "p50 ms", "p99 ms", "storage", "backend", "telegram"))
+    for command, stats in report['commands'].items():
+        print("{:<16}{:>7}{:>9.2f}{:>9.2f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            command, stats['count'], stats['p50_ms'], stats['p99_ms'], stats['storage_calls_per_op'],
+            stats['backend_calls_per_op'], stats['telegram_calls_per_op']))
+    print("throughput: {:.0f} updates/s".format(report['throughput_per_second']))
+    if report['planner'] is not None:
+        print("planner: {ms:.1f} ms, {planned} reminders planned, {storage_calls} storage calls, "
+              "{backend_calls} backend calls".format(**report['planner']))
+    print("reminder run: {ms:.1f} ms, {sent} sent, {failed} failed, {storage_calls} storage calls, "
+          "{backend_calls} backend calls, {telegram_calls} Bot API calls".format(**report['reminder']))
+    for run in report['sharded_reminders']:
+        print("reminder run with {shards} shards: {ms:.1f} ms, {sent} sent, {failed} failed, {telegram_calls} Bot API "
+              "calls, {speedup:.2f}x".format(**run))
+    if report['peak_memory_bytes'] is not None:
+        print("peak traced memory: {:.1f} MiB".format(report['peak_memory_bytes'] / (1024 * 1024)))
+
+
+if __name__ == '__main__':
+    main()
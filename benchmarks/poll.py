@@ -0,0 +1,90 @@
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import typing
+
+from load import DEFAULT_MIX, UpdateStream, parse_mix, seed_storages, start_environment
+
+# Throughput of the long polling mode (python src/cli.py poll) against the local fake Bot API. The same
+# synthetic updates as benchmarks/load.py are queued on the fake server, then drained by a Poller with each
+# of the given worker counts. The fake answers after --api-latency-ms, standing in for the round trip to
+# Telegram that the workers overlap:
+#
+#   python benchmarks/poll.py --storage Redis --updates 5000 --workers 1,4,16
+#
+# Reported per worker count: updates per second, getUpdates calls and the mean batch size.
+
+
+def drain(bot: typing.Any, telegram: typing.Any, workers: int, updates: typing.List[dict], timeout: int) -> dict:
+    from src import polling
+
+    telegram.add_updates(updates)
+    get_updates_calls = telegram.calls["getUpdates"]
+    poller = polling.Poller(bot, workers=workers, timeout=timeout)
+    thread = threading.Thread(target=poller.run, daemon=True)
+    started = time.perf_counter()
+    thread.start()
+    # The fake drops the updates once a getUpdates call confirms them, i.e. after their batch was handled
+    while telegram.pending() > 0:
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    batches = telegram.calls["getUpdates"] - get_updates_calls
+    poller.stop()
+    thread.join()
+    return {
+        'workers': workers,
+        'updates': poller.handled,
+        'seconds': elapsed,
+        'throughput_per_second': poller.handled / elapsed,
+        'get_updates_calls': batches,
+        'mean_batch_size': poller.handled / max(1, batches - 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long polling throughput benchmark")
+    parser.add_argument("--storage", choices=["Memory", "Redis", "DynamoDB"], default="Memory")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--birthdays", type=int, default=20, help="birthdays stored per user before the run")
+    parser.add_argument("--updates", type=int, default=2000, help="updates drained per worker count")
+    parser.add_argument("--workers", default="1,4,16", help="comma separated worker counts")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="command=weight pairs")
+    parser.add_argument("--today", type=float, default=0.05, help="share of the birthdays that fall today")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redis-url", default=None, help="use this Redis (it is flushed) instead of fakeredis")
+    parser.add_argument("--poll-timeout", type=int, default=1, help="long polling timeout in seconds")
+    parser.add_argument("--api-latency-ms", type=float, default=20, help="delay of the fake Bot API answers")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    telegram, _counter = start_environment(args, api_latency=args.api_latency_ms / 1000)
+
+    import src.handlers  # for side effects
+    from src.bot import bot
+
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    chat_ids, names = seed_storages(args, rng, now)
+    stream = UpdateStream(rng, chat_ids, names, parse_mix(args.mix))
+
+    runs = []
+    for workers in (int(workers) for workers in args.workers.split(",")):
+        updates = [stream.next()[1] for _ in range(args.updates)]
+        runs.append(drain(bot, telegram, workers, updates, args.poll_timeout))
+    telegram.stop()
+
+    if args.json:
+        print(json.dumps({'storage': args.storage, 'runs': runs}, indent=2))
+        return
+    print("{} storage, {} users, {} updates per run".format(args.storage, args.users, args.updates))
+    print("{:>8}{:>12}{:>14}{:>12}".format("workers", "updates/s", "getUpdates", "batch size"))
+    for run in runs:
+        print("{workers:>8}{throughput_per_second:>12.0f}{get_updates_calls:>14}{mean_batch_size:>12.1f}".format(
+            **run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from src.reminders import plan, reminder, remind_shard, REMINDER_SHARDS
+from src import metrics
+
+logger = logging.getLogger("root")
+logging.getLogger().setLevel(logging.INFO)
+
+
+def handler(event, context):
+    try:
+        return remind(event, context)
+    finally:
+        metrics.flush_emf()
+
+
+def remind(event, context):
+    if event.get('plan'):
+        # Daily planner run, see src/reminder_plan.py
+        day = datetime.date.fromisoformat(event['day']) if event.get('day') else None
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'planned': plan(day)})
+        }
+    if event.get('shard') is not None:
+        now = datetime.datetime.fromisoformat(event['now'])
+        summary = remind_shard(now, event['shard'], event['shards'])
+    elif REMINDER_SHARDS > 1:
+        # Each shard runs in its own asynchronous invocation of this function; failed invocations are
+        # retried by Lambda and resume from the shard's checkpoint
+        import boto3
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        lambda_client = boto3.client('lambda')
+        for shard in range(REMINDER_SHARDS):
+            lambda_client.invoke(
+                FunctionName=context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'shard': shard, 'shards': REMINDER_SHARDS, 'now': now.isoformat()}),
+            )
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'shards': REMINDER_SHARDS})
+        }
+    else:
+        summary = reminder()
+    return {
+        'statusCode': 200,
+        'body': json.dumps(dataclasses.asdict(summary))
+    }
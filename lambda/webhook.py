@@ -0,0 +1,52 @@
+import json
+import logging
+import os
+import sys
+import telebot
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from src.handlers import *  # for side effects
+from src.bot import bot
+from src import metrics, replies
+
+logger = logging.getLogger("root")
+logging.getLogger().setLevel(logging.INFO)
+
+
+def handler(event, context):
+    try:
+        return webhook(event, context)
+    finally:
+        metrics.flush_emf()
+
+
+def webhook(event, _context):
+    logger.debug("Received event: {}".format(event))
+    event_body_str = json.loads(event['body'])
+    if "message" not in event_body_str and "callback_query" not in event_body_str:
+        logger.info("No message or callback query in post data")
+        return {"statusCode": 200}
+    try:
+        update = telebot.types.Update.de_json(event_body_str)
+        with replies.collect() as collected:
+            bot.process_new_updates([update])
+        response_body = replies.webhook_response(collected)
+        if response_body is None:
+            return {'statusCode': 200}
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps(response_body)
+        }
+    except Exception as e:
+        message = event_body_str.get("message") or event_body_str["callback_query"]["message"]
+        chat_id = message["chat"]["id"]
+        bot.send_message(chat_id=chat_id, text='An error occurred while processing your request: {}'.format(str(e)))
+        logger.error("An error occurred while processing the request: {}".format(e))
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'error': str(e)})
+        }
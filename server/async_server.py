@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import os
+import sys
+import telebot
+
+from aiohttp import web
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from src.handlers import *  # for side effects
+from src.bot import bot
+from src import metrics
+from src.polling import ChatDispatcher
+
+logger = logging.getLogger("root")
+logging.getLogger().setLevel(logging.INFO)
+
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '32'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1024'))
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8000'))
+
+
+async def webhook(request: web.Request) -> web.Response:
+    update = telebot.types.Update.de_json(await request.text())
+    # Updates are acknowledged as soon as they are queued, the handlers and storages run on the worker threads
+    if not request.app['dispatcher'].submit(update, block=False):
+        # Telegram retries updates that are not acknowledged, which is the backpressure we want when full
+        return web.Response(status=503)
+    return web.Response(status=200)
+
+
+async def prometheus_metrics(_request: web.Request) -> web.Response:
+    return web.Response(body=metrics.prometheus_text(), headers={'Content-Type': metrics.PROMETHEUS_CONTENT_TYPE})
+
+
+async def start_dispatcher(app: web.Application):
+    app['dispatcher'] = ChatDispatcher(bot, WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, name="webhook")
+    app['dispatcher'].start()
+
+
+async def stop_dispatcher(app: web.Application):
+    # The queued updates are handled before the server exits
+    await asyncio.get_running_loop().run_in_executor(None, app['dispatcher'].join)
+
+
+def build_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post('/', webhook)
+    app.router.add_get('/metrics', prometheus_metrics)
+    app.on_startup.append(start_dispatcher)
+    app.on_shutdown.append(stop_dispatcher)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(build_app(), host='0.0.0.0', port=WEBHOOK_PORT)
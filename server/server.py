@@ -1,27 +1,37 @@
 import os
 import sys
 import telebot
-from flask import Flask, request
+from flask import Flask, jsonify, request
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
 from src.handlers import *
-from src.bot import commands, bot
+from src.bot import bot
+from src import metrics, replies
 
 logger = logging.getLogger("root")
 logging.getLogger().setLevel(logging.INFO)
 
-bot.set_my_commands(commands)
+# Commands are registered once per deployment with `python src/cli.py set-commands`, not on every start
 app = Flask(__name__)
 
 
 @app.route('/', methods=['POST'])
 def webhook():
     update = telebot.types.Update.de_json(request.stream.read().decode('utf-8'))
-    bot.process_new_updates([update])
-    return '', 200
+    with replies.collect() as collected:
+        bot.process_new_updates([update])
+    response_body = replies.webhook_response(collected)
+    if response_body is None:
+        return '', 200
+    return jsonify(response_body), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return metrics.prometheus_text(), 200, {'Content-Type': metrics.PROMETHEUS_CONTENT_TYPE}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+import csv
+import io
+import itertools
+import re
+import typing
+
+from src.birthday_storage import Birthday
+
+# Apple Contacts stores birthdays without a year as 1604
+NO_YEAR_PLACEHOLDER = 1604
+ICS_NAME_SUFFIX = re.compile(r"('s)?\s+birthday$", re.IGNORECASE)
+
+Record = typing.Tuple[int, str, str]  # line number, name, dd/mm(/yyyy)
+
+
+def read_birthdays(lines: typing.Iterable[str], invalid_lines: typing.List[int]) -> typing.Iterator[Birthday]:
+    # Detects CSV, vCard or iCalendar from the first non-empty line and parses the rest lazily.
+    # Line numbers of records that fail validation are appended to invalid_lines.
+    lines = iter(lines)
+    first_line = ""
+    for first_line in lines:
+        if first_line.strip() != "":
+            break
+    lines = itertools.chain([first_line], lines)
+    header = first_line.strip().upper()
+    if header == "BEGIN:VCARD":
+        records = _parse_vcard(lines)
+    elif header == "BEGIN:VCALENDAR":
+        records = _parse_ics(lines)
+    else:
+        records = _parse_csv(lines)
+    for line_number, name, date_str in records:
+        try:
+            if name == "":
+                raise ValueError("Missing name")
+            yield Birthday(name=name, date_str=date_str)
+        except ValueError:
+            invalid_lines.append(line_number)
+
+
+def write_csv(birthdays: typing.Iterable[Birthday]) -> typing.Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["name", "date"])
+    for birthday in birthdays:
+        writer.writerow([birthday.name, birthday.date_format()])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _parse_csv(lines: typing.Iterable[str]) -> typing.Iterator[Record]:
+    # name,date rows, with the date as dd/mm(/yyyy) or yyyy-mm-dd; an optional header row is skipped
+    for line_number, row in enumerate(csv.reader(lines), start=1):
+        if len(row) == 0 or all(cell.strip() == "" for cell in row):
+            continue
+        if line_number == 1 and row[0].strip().lower() == "name":
+            continue
+        if len(row) < 2:
+            yield line_number, row[0].strip(), ""
+            continue
+        date_str = row[1].strip()
+        if "-" in date_str:
+            date_str = _iso_date_str(date_str)
+        yield line_number, row[0].strip(), date_str
+
+
+def _parse_vcard(lines: typing.Iterable[str]) -> typing.Iterator[Record]:
+    name, birthday, start = "", "", 0
+    for line_number, key, value in _unfold(lines):
+        if key == "BEGIN":
+            name, birthday, start = "", "", line_number
+        elif key == "FN":
+            name = _unescape(value)
+        elif key == "BDAY":
+            birthday = value
+        elif key == "END" and value.upper() == "VCARD" and birthday != "":
+            yield start, name, _iso_date_str(birthday)
+
+
+def _parse_ics(lines: typing.Iterable[str]) -> typing.Iterator[Record]:
+    name, start_date, start = "", "", 0
+    for line_number, key, value in _unfold(lines):
+        if key == "BEGIN" and value.upper() == "VEVENT":
+            name, start_date, start = "", "", line_number
+        elif key == "SUMMARY":
+            name = ICS_NAME_SUFFIX.sub("", _unescape(value)).strip()
+        elif key == "DTSTART":
+            start_date = value
+        elif key == "END" and value.upper() == "VEVENT" and start_date != "":
+            yield start, name, _iso_date_str(start_date[:8])
+
+
+def _unfold(lines: typing.Iterable[str]) -> typing.Iterator[typing.Tuple[int, str, str]]:
+    # Joins folded content lines (continuations start with a space or tab) and splits them into
+    # (line number, property name without parameters, value)
+    current, current_line_number = None, 0
+    for line_number, line in enumerate(lines, start=1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield _split_property(current_line_number, current)
+        current, current_line_number = line, line_number
+    if current is not None:
+        yield _split_property(current_line_number, current)
+
+
+def _split_property(line_number: int, line: str) -> typing.Tuple[int, str, str]:
+    key, _, value = line.partition(":")
+    # Drops parameters such as DTSTART;VALUE=DATE and item1.BDAY grouping prefixes
+    key = key.split(";", 1)[0].rsplit(".", 1)[-1].upper()
+    return line_number, key, value.strip()
+
+
+def _unescape(value: str) -> str:
+    return value.replace("\\,", ",").replace("\\;", ";").replace("\\n", " ").replace("\\\\", "\\").strip()
+
+
+def _iso_date_str(value: str) -> str:
+    # yyyy-mm-dd, yyyymmdd, --mm-dd or --mmdd to dd/mm(/yyyy)
+    value = value.strip()
+    if value.startswith("--"):
+        digits = value[2:].replace("-", "")
+        year = None
+    else:
+        digits = value.split("T", 1)[0].replace("-", "")
+        year = digits[:-4]
+        digits = digits[-4:]
+    if len(digits) != 4 or not digits.isdigit():
+        return value
+    month, day = digits[:2], digits[2:]
+    if not year or not year.isdigit() or int(year) == NO_YEAR_PLACEHOLDER:
+        return "{}/{}".format(day, month)
+    return "{}/{}/{}".format(day, month, year)
@@ -1,47 +1,105 @@
+import bisect
+import calendar
+import collections
 import dataclasses
+import itertools
+import sys
+import threading
+import time
 import typing
-import boto3
 import logging
 import datetime
-import redis
 import os
 
-from botocore import config as botocore_config
-from src import utils
+from concurrent import futures
+from src import dynamo_codec, dynamodb_client, redis_client, utils
+
+if typing.TYPE_CHECKING:
+    import redis
 
 logger = logging.getLogger("root")
 logging.getLogger().setLevel(logging.INFO)
 
+# The cache is per process and only sees that process' writes, so it is off unless a single process serves
+# every update (server/async_server.py). Lambda containers would serve each other's stale lists.
+BIRTHDAY_CACHE_TTL = float(os.getenv('BIRTHDAY_CACHE_TTL', '0'))
+BIRTHDAY_CACHE_MAX_ENTRIES = int(os.getenv('BIRTHDAY_CACHE_MAX_ENTRIES', '1024'))
+BIRTHDAY_CACHE_MAX_BYTES = int(os.getenv('BIRTHDAY_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Birthday:
     name: str
     day: int
     month: int
     year: typing.Optional[int] = None
-
-    def date_format(self) -> str:
-        if self.year is None:
-            return datetime.date(1900, self.month, self.day).strftime("%d/%m")
-        return datetime.date(self.year, self.month, self.day).strftime("%d/%m/%Y")
+    # date_format() result, built on first use
+    _date_str: typing.Optional[str] = dataclasses.field(default=None, repr=False, compare=False)
 
     def __init__(self, name: str, date_str: str):
-        date_parts = date_str.split("/")
-        if len(date_parts) == 2:
-            day, month = date_parts
-            year = None
-        elif len(date_parts) == 3:
-            day, month, year = date_parts
-        else:
-            raise ValueError("Invalid date format")
-        self.name = name
-        self.day = int(day)
-        self.month = int(month)
-        self.year = int(year) if year is not None else None
-        try:
-            self.date_format()
-        except ValueError:
+        day, month, year = _parse_date_str(date_str)
+        if not _is_valid_date(day, month, year):
             raise ValueError("Invalid date value")
+        self.name = name
+        self.day = day
+        self.month = month
+        self.year = year
+        self._date_str = None
+
+    @classmethod
+    def from_parts(cls, name: str, day: int, month: int, year: typing.Optional[int] = None) -> 'Birthday':
+        # Builds a birthday read back from a storage, which was validated when it was stored
+        birthday = cls.__new__(cls)
+        birthday.name = name
+        birthday.day = day
+        birthday.month = month
+        birthday.year = year
+        birthday._date_str = None
+        return birthday
+
+    @classmethod
+    def from_packed(cls, name: str, packed: int) -> 'Birthday':
+        mmdd, year = divmod(packed, 10000)
+        month, day = divmod(mmdd, 100)
+        return cls.from_parts(name, day, month, year or None)
+
+    @property
+    def mmdd(self) -> int:
+        return self.month * 100 + self.day
+
+    @property
+    def packed(self) -> int:
+        # MMDDYYYY with 0000 for no year: ordered by day of the year first, and packed // 10000 is the MMDD
+        # that the day indexes are keyed by
+        return self.mmdd * 10000 + (self.year or 0)
+
+    def date_format(self) -> str:
+        if self._date_str is None:
+            if self.year is None:
+                self._date_str = "{:02d}/{:02d}".format(self.day, self.month)
+            else:
+                self._date_str = "{:02d}/{:02d}/{:04d}".format(self.day, self.month, self.year)
+        return self._date_str
+
+
+def _parse_date_str(date_str: str) -> typing.Tuple[int, int, typing.Optional[int]]:
+    # dd/mm(/yyyy) to (day, month, year)
+    date_parts = date_str.split("/")
+    if len(date_parts) == 2:
+        return int(date_parts[0]), int(date_parts[1]), None
+    elif len(date_parts) == 3:
+        return int(date_parts[0]), int(date_parts[1]), int(date_parts[2])
+    else:
+        raise ValueError("Invalid date format")
+
+
+def _is_valid_date(day: int, month: int, year: typing.Optional[int]) -> bool:
+    if year is not None and not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+        return False
+    if not 1 <= month <= 12:
+        return False
+    # Without a year 29/02 is valid, it is celebrated on the 28th in non-leap years
+    return 1 <= day <= calendar.monthrange(year if year is not None else 2000, month)[1]
 
 
 class BirthdayStorage:
@@ -50,180 +108,575 @@ class BirthdayStorage:
     def load_birthdays_by_chat_id(self, chat_id: str) -> typing.List[Birthday]:
         pass
 
-    def load_birthdays_by_day(self, day: datetime.date) -> typing.List[typing.Tuple[str, Birthday]]:
+    def iter_birthdays_by_chat_id(self, chat_id: str) -> typing.Iterator[Birthday]:
+        # Same birthdays as load_birthdays_by_chat_id, in no particular order, read as they are consumed
+        yield from self.load_birthdays_by_chat_id(chat_id)
+
+    def load_birthdays_by_day(self, day: datetime.date) -> typing.Iterable[typing.Tuple[str, Birthday]]:
         pass
 
-    def store_birthday(self, chat_id: str, birthday: Birthday):
+    def load_birthdays_by_days(
+            self, days: typing.Iterable[datetime.date]
+    ) -> typing.Iterable[typing.Tuple[datetime.date, str, Birthday]]:
+        # (day, chat_id, birthday) for the birthdays celebrated on each of `days`, read from the day index:
+        # the cost follows the number of dates and matching birthdays, not the number of stored ones
+        for day in days:
+            for chat_id, birthday in self.load_birthdays_by_day(day):
+                yield day, chat_id, birthday
+
+    def store_birthday(self, chat_id: str, birthday: Birthday) -> typing.Optional[Birthday]:
+        # Returns the birthday it replaced, None when the name was new
         pass
 
+    def store_birthdays_bulk(self, chat_id: str, birthdays: typing.Iterable[Birthday]) -> int:
+        stored = 0
+        for birthday in birthdays:
+            self.store_birthday(chat_id, birthday)
+            stored += 1
+        return stored
+
+    def load_upcoming(self, chat_id: str, start: datetime.date, days: int) -> typing.List[Birthday]:
+        # Birthdays within [start, start + days), ordered by their next occurrence
+        return upcoming_birthdays(self.load_birthdays_by_chat_id(chat_id), start, days)
+
+    def load_birthdays_page(
+            self, chat_id: str, cursor: typing.Optional[str], limit: int
+    ) -> typing.Tuple[typing.List[Birthday], typing.Optional[str]]:
+        # Up to `limit` birthdays ordered by day of the year, starting at `cursor` (None for the first page),
+        # and the cursor of the next page, None after the last one. Cursors are opaque strings that are only
+        # understood by the storage that returned them.
+        birthdays = sorted(self.load_birthdays_by_chat_id(chat_id), key=lambda b: (b.mmdd, b.name))
+        offset = int(cursor) if cursor else 0
+        next_offset = offset + limit
+        return birthdays[offset:next_offset], str(next_offset) if next_offset < len(birthdays) else None
+
     def get_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
         pass
 
-    def delete_birthday(self, chat_id: str, name: str):
+    def delete_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
+        # Returns the deleted birthday, None when there was none
         pass
 
 
 class MemoryBirthdayStorage(BirthdayStorage):
-    birthdays: typing.Dict[str, typing.List[Birthday]]
+    # Names are matched case-insensitively, every index is keyed by the normalized name
+    birthdays: typing.Dict[str, typing.Dict[str, Birthday]]
+    # (month, day) -> {(chat_id, normalized name)}, read by the reminder
+    days: typing.Dict[typing.Tuple[int, int], typing.Set[typing.Tuple[str, str]]]
+    # chat_id -> (mmdd, normalized name, birthday) sorted, bisected by load_upcoming
+    upcoming: typing.Dict[str, typing.List[typing.Tuple[int, str, Birthday]]]
 
     def __init__(self):
         self.birthdays = {}
+        self.days = {}
+        self.upcoming = {}
+
+    @staticmethod
+    def _normalize(name: str) -> str:
+        return name.lower()
 
     def load_birthdays_by_chat_id(self, chat_id: str) -> typing.List[Birthday]:
-        if chat_id not in self.birthdays:
-            return []
-        return self.birthdays[chat_id]
+        return list(self.birthdays.get(chat_id, {}).values())
 
     def load_birthdays_by_day(self, day: datetime.date) -> typing.List[typing.Tuple[str, Birthday]]:
-        birthday_list: typing.List[typing.Tuple[str, Birthday]] = []
-        for chat_id, birthday in self.birthdays:
-            if day.day == birthday.day and day.month == birthday.month:
-                birthday_list.append((chat_id, birthday))
-        return birthday_list
-
-    def store_birthday(self, chat_id: str, birthday: Birthday):
-        if chat_id not in self.birthdays:
-            self.birthdays[chat_id] = []
-        for i in range(len(self.birthdays[chat_id])):
-            b = self.birthdays[chat_id][i]
-            if b.name.lower() == birthday.name.lower():
-                self.birthdays[chat_id][i] = birthday
-                break
-        else:
-            self.birthdays[chat_id].append(birthday)
+        return [
+            (chat_id, self.birthdays[chat_id][key])
+            for month, day_of_month in utils.birthday_days(day)
+            for chat_id, key in self.days.get((month, day_of_month), ())
+        ]
+
+    def load_upcoming(self, chat_id: str, start: datetime.date, days: int) -> typing.List[Birthday]:
+        index = self.upcoming.get(chat_id, [])
+        birthdays: typing.List[Birthday] = []
+        for low, high in utils.upcoming_ranges(start, days):
+            begin, end = bisect.bisect_left(index, (low,)), bisect.bisect_left(index, (high + 1,))
+            birthdays += [birthday for _, _, birthday in index[begin:end]]
+        return birthdays
+
+    def load_birthdays_page(
+            self, chat_id: str, cursor: typing.Optional[str], limit: int
+    ) -> typing.Tuple[typing.List[Birthday], typing.Optional[str]]:
+        # Cursors are the index position {mmdd}:{normalized name} of the last birthday returned
+        index = self.upcoming.get(chat_id, [])
+        begin = 0
+        if cursor:
+            mmdd, key = cursor.split(":", 1)
+            begin = bisect.bisect_left(index, (int(mmdd), key))
+            if begin < len(index) and index[begin][:2] == (int(mmdd), key):
+                begin += 1
+        entries = index[begin:begin + limit]
+        next_cursor = None
+        if begin + limit < len(index):
+            next_cursor = "{}:{}".format(*entries[-1][:2])
+        return [birthday for _, _, birthday in entries], next_cursor
+
+    def store_birthday(self, chat_id: str, birthday: Birthday) -> typing.Optional[Birthday]:
+        key = self._normalize(birthday.name)
+        chat_birthdays = self.birthdays.setdefault(chat_id, {})
+        previous = chat_birthdays.get(key)
+        if previous is not None:
+            self._unindex(chat_id, key, previous)
+        chat_birthdays[key] = birthday
+        self.days.setdefault((birthday.month, birthday.day), set()).add((chat_id, key))
+        bisect.insort(self.upcoming.setdefault(chat_id, []), (birthday.mmdd, key, birthday))
+        return previous
 
     def get_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
-        for birthday in self.birthdays[chat_id]:
-            if birthday.name.lower() == name.lower():
-                return birthday
-        return None
+        return self.birthdays.get(chat_id, {}).get(self._normalize(name))
 
-    def delete_birthday(self, chat_id: str, name: str) -> bool:
-        for i in range(len(self.birthdays)):
-            birthday = self.birthdays[chat_id][i]
-            if birthday.name.lower() == name.lower():
-                self.birthdays[chat_id].pop(i)
-                return True
-        return False
+    def delete_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
+        key = self._normalize(name)
+        birthday = self.birthdays.get(chat_id, {}).pop(key, None)
+        if birthday is None:
+            return None
+        self._unindex(chat_id, key, birthday)
+        if len(self.birthdays[chat_id]) == 0:
+            del self.birthdays[chat_id]
+            del self.upcoming[chat_id]
+        return birthday
 
+    def _unindex(self, chat_id: str, key: str, birthday: Birthday):
+        day_members = self.days[(birthday.month, birthday.day)]
+        day_members.discard((chat_id, key))
+        if len(day_members) == 0:
+            del self.days[(birthday.month, birthday.day)]
+        index = self.upcoming[chat_id]
+        index.pop(bisect.bisect_left(index, (birthday.mmdd, key)))
 
-class RedisBirthdayStorage(BirthdayStorage):
-    # redis: redis.Redis
 
-    def __init__(self, host: str, port: int, db: int):
-        self.redis = redis.Redis(host=host, port=port, db=db)
+class RedisBirthdayStorage(BirthdayStorage):
+    # Data model:
+    #   birthdays:{chat_id} -> hash of name -> packed date (see Birthday.packed), dd/mm(/yyyy) when older
+    #   bday:{MM-DD}        -> set of {chat_id}/{name} members, the day index used by the reminder
+    #   upcoming:{chat_id}  -> sorted set of names scored by MMDD, the index used by /listupcoming
+    # All are kept in sync by Lua scripts, so a store or delete is atomic and takes a single round trip.
+
+    # Day index key of a stored date, either packed or dd/mm(/yyyy)
+    DAY_KEY_FUNCTION = """
+        local function day_key(date)
+            local day, month = string.match(date, '^(%d+)/(%d+)')
+            if not day then
+                local mmdd = math.floor(tonumber(date) / 10000)
+                month, day = math.floor(mmdd / 100), mmdd % 100
+            end
+            return string.format('bday:%02d-%02d', tonumber(month), tonumber(day))
+        end
+    """
+
+    STORE_SCRIPT = DAY_KEY_FUNCTION + """
+        local old = redis.call('HGET', KEYS[1], ARGV[1])
+        if old then
+            redis.call('SREM', day_key(old), ARGV[3])
+        end
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        redis.call('SADD', KEYS[2], ARGV[3])
+        redis.call('ZADD', KEYS[3], ARGV[4], ARGV[1])
+        return old
+    """
+
+    DELETE_SCRIPT = DAY_KEY_FUNCTION + """
+        local old = redis.call('HGET', KEYS[1], ARGV[1])
+        if not old then
+            return false
+        end
+        redis.call('SREM', day_key(old), ARGV[2])
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        redis.call('ZREM', KEYS[2], ARGV[1])
+        return old
+    """
+
+    # ARGV holds inclusive (low, high) MMDD pairs; returns name, date pairs in range order
+    LOAD_UPCOMING_SCRIPT = """
+        local result = {}
+        for i = 1, #ARGV, 2 do
+            local names = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[i], ARGV[i + 1])
+            -- HMGET in chunks, unpack can't spread arbitrarily long lists
+            for first = 1, #names, 1000 do
+                local last = math.min(first + 999, #names)
+                local dates = redis.call('HMGET', KEYS[2], unpack(names, first, last))
+                for j = first, last do
+                    local date = dates[j - first + 1]
+                    if date then
+                        table.insert(result, names[j])
+                        table.insert(result, date)
+                    end
+                end
+            end
+        end
+        return result
+    """
+
+    # Returns name, date pairs of the upcoming zset entries ranked ARGV[1] to ARGV[2]
+    LOAD_PAGE_SCRIPT = """
+        local result = {}
+        local names = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[2])
+        if #names == 0 then
+            return result
+        end
+        local dates = redis.call('HMGET', KEYS[2], unpack(names))
+        for i = 1, #names do
+            if dates[i] then
+                table.insert(result, names[i])
+                table.insert(result, dates[i])
+            end
+        end
+        return result
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, client: "redis.Redis"):
+        self.redis = client
+        self.store_script = self.redis.register_script(self.STORE_SCRIPT)
+        self.delete_script = self.redis.register_script(self.DELETE_SCRIPT)
+        self.load_upcoming_script = self.redis.register_script(self.LOAD_UPCOMING_SCRIPT)
+        self.load_page_script = self.redis.register_script(self.LOAD_PAGE_SCRIPT)
+
+    @staticmethod
+    def _chat_key(chat_id: str) -> str:
+        return f"birthdays:{chat_id}"
+
+    @staticmethod
+    def _upcoming_key(chat_id: str) -> str:
+        return f"upcoming:{chat_id}"
+
+    @staticmethod
+    def _day_key(month: int, day: int) -> str:
+        return f"bday:{month:02d}-{day:02d}"
+
+    @staticmethod
+    def _member(chat_id: str, name: str) -> str:
+        return f"{chat_id}/{name}"
+
+    @staticmethod
+    def _birthday(name: str, date: str) -> Birthday:
+        if "/" in date:
+            day, month, year = _parse_date_str(date)
+            return Birthday.from_parts(name, day, month, year)
+        return Birthday.from_packed(name, int(date))
 
     def load_birthdays_by_chat_id(self, chat_id: str) -> typing.List[Birthday]:
-        birthdays: typing.List[Birthday] = []
-        for key in self.redis.scan_iter(match=f"birthday:{chat_id}:*"):
-            name = key.decode("utf-8").split(":")[2]
-            date = self.redis.get(key).decode("utf-8")
-            birthdays.append(Birthday(name, date))
-        return birthdays
+        return [
+            self._birthday(name.decode("utf-8"), date.decode("utf-8"))
+            for name, date in self.redis.hgetall(self._chat_key(chat_id)).items()
+        ]
 
     def load_birthdays_by_day(self, day: datetime.date) -> typing.List[typing.Tuple[str, Birthday]]:
-        birthdays: typing.List[typing.Tuple[str, Birthday]] = []
-        for key in self.redis.scan_iter(match=f"birthday:*:{day.day}/{day.month}*"):
-            chat_id = key.decode("utf-8").split(":")[1]
-            name = key.decode("utf-8").split(":")[2]
-            date = self.redis.get(key).decode("utf-8")
-            birthdays.append((chat_id, Birthday(name, date)))
+        return [(chat_id, birthday) for _, chat_id, birthday in self.load_birthdays_by_days([day])]
+
+    def load_birthdays_by_days(
+            self, days: typing.Iterable[datetime.date]
+    ) -> typing.List[typing.Tuple[datetime.date, str, Birthday]]:
+        # The day index sets are read with one pipeline, then the dates with one HMGET per chat, pipelined in
+        # batches: every key is passed by the client and no single call blocks the server on a popular day
+        dates_by_day = _dates_by_birthday_day(days)
+        if len(dates_by_day) == 0:
+            return []
+        pipeline = self.redis.pipeline(transaction=False)
+        for month, day in dates_by_day:
+            pipeline.smembers(self._day_key(month, day))
+        # chat_id -> name -> dates the birthday answers
+        names_by_chat: typing.Dict[str, typing.Dict[str, typing.List[datetime.date]]] = {}
+        for dates, members in zip(dates_by_day.values(), pipeline.execute()):
+            for member in members:
+                chat_id, _, name = member.decode("utf-8").partition("/")
+                names_by_chat.setdefault(chat_id, {}).setdefault(name, []).extend(dates)
+        birthdays: typing.List[typing.Tuple[datetime.date, str, Birthday]] = []
+        chat_ids = list(names_by_chat)
+        for begin in range(0, len(chat_ids), self.BATCH_SIZE):
+            batch = chat_ids[begin:begin + self.BATCH_SIZE]
+            pipeline = self.redis.pipeline(transaction=False)
+            for chat_id in batch:
+                pipeline.hmget(self._chat_key(chat_id), list(names_by_chat[chat_id]))
+            for chat_id, values in zip(batch, pipeline.execute()):
+                for (name, dates), date in zip(names_by_chat[chat_id].items(), values):
+                    # None when the birthday was deleted after the day index was read
+                    if date is not None:
+                        birthday = self._birthday(name, date.decode("utf-8"))
+                        birthdays += [(day, chat_id, birthday) for day in dates]
         return birthdays
 
-    def store_birthday(self, chat_id: str, birthday: Birthday):
-        self.redis.set(f"birthday:{chat_id}:{birthday.name}", birthday.date_format())
+    def load_upcoming(self, chat_id: str, start: datetime.date, days: int) -> typing.List[Birthday]:
+        ranges = utils.upcoming_ranges(start, days)
+        if len(ranges) == 0:
+            return []
+        result = self.load_upcoming_script(
+            keys=[self._upcoming_key(chat_id), self._chat_key(chat_id)],
+            args=[bound for low_high in ranges for bound in low_high],
+        )
+        return [
+            self._birthday(result[i].decode("utf-8"), result[i + 1].decode("utf-8"))
+            for i in range(0, len(result), 2)
+        ]
+
+    def load_birthdays_page(
+            self, chat_id: str, cursor: typing.Optional[str], limit: int
+    ) -> typing.Tuple[typing.List[Birthday], typing.Optional[str]]:
+        # Cursors are ranks in the upcoming zset, one more entry than needed tells whether there is a next page
+        offset = int(cursor) if cursor else 0
+        result = self.load_page_script(
+            keys=[self._upcoming_key(chat_id), self._chat_key(chat_id)],
+            args=[offset, offset + limit],
+        )
+        birthdays = [
+            self._birthday(result[i].decode("utf-8"), result[i + 1].decode("utf-8"))
+            for i in range(0, len(result), 2)
+        ]
+        if len(birthdays) > limit:
+            return birthdays[:limit], str(offset + limit)
+        return birthdays, None
+
+    def store_birthday(self, chat_id: str, birthday: Birthday) -> typing.Optional[Birthday]:
+        previous = self._store(chat_id, birthday)
+        return self._birthday(birthday.name, previous.decode("utf-8")) if previous is not None else None
+
+    def store_birthdays_bulk(self, chat_id: str, birthdays: typing.Iterable[Birthday]) -> int:
+        stored = 0
+        pipeline = self.redis.pipeline(transaction=False)
+        for birthday in birthdays:
+            self._store(chat_id, birthday, client=pipeline)
+            stored += 1
+            if stored % self.BATCH_SIZE == 0:
+                pipeline.execute()
+        pipeline.execute()
+        return stored
+
+    def _store(self, chat_id: str, birthday: Birthday, client: typing.Optional["redis.client.Pipeline"] = None):
+        # The previous date of the name, or the pipeline when given one
+        return self.store_script(
+            keys=[
+                self._chat_key(chat_id),
+                self._day_key(birthday.month, birthday.day),
+                self._upcoming_key(chat_id),
+            ],
+            args=[
+                birthday.name,
+                birthday.packed,
+                self._member(chat_id, birthday.name),
+                birthday.mmdd,
+            ],
+            client=client,
+        )
 
     def get_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
-        date: bytes = self.redis.get(f"birthday:{chat_id}:{name}")
+        date: bytes = self.redis.hget(self._chat_key(chat_id), name)
         if date is not None:
-            return Birthday(name, date.decode("utf-8"))
+            return self._birthday(name, date.decode("utf-8"))
         return None
 
-    def delete_birthday(self, chat_id: str, name: str) -> bool:
-        return self.redis.delete(f"birthday:{chat_id}:{name}") == 1
+    def delete_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
+        date = self.delete_script(
+            keys=[self._chat_key(chat_id), self._upcoming_key(chat_id)],
+            args=[name, self._member(chat_id, name)],
+        )
+        return self._birthday(name, date.decode("utf-8")) if date is not None else None
+
+    def migrate_legacy_keys(self) -> int:
+        # Moves birthdays stored as birthday:{chat_id}:{name} -> date strings into the indexed data model
+        migrated = 0
+        keys: typing.List[bytes] = []
+        for key in self.redis.scan_iter(match="birthday:*", count=self.BATCH_SIZE):
+            keys.append(key)
+            if len(keys) == self.BATCH_SIZE:
+                migrated += self._migrate_legacy_batch(keys)
+                keys = []
+        if keys:
+            migrated += self._migrate_legacy_batch(keys)
+        return migrated
+
+    def _migrate_legacy_batch(self, keys: typing.List[bytes]) -> int:
+        migrated = 0
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, date in zip(keys, self.redis.mget(keys)):
+            if date is None:
+                continue
+            _, chat_id, name = key.decode("utf-8").split(":", 2)
+            self._store(chat_id, Birthday(name, date.decode("utf-8")), client=pipeline)
+            pipeline.delete(key)
+            migrated += 1
+        pipeline.execute()
+        return migrated
 
 
 class DynamoDBBirthdayStorage(BirthdayStorage):
     table_name: str = None
-    dynamodb: boto3.resource = None
-    table: boto3.resource = None
+
+    BATCH_WRITE_SIZE = 25
+    BATCH_WRITE_WORKERS = 4
+    BATCH_WRITE_MAX_ATTEMPTS = 8
+    QUERY_WORKERS = 4
 
     def __init__(self, table_name: str):
         self.table_name = table_name
-        dynamodb_config = botocore_config.Config(connect_timeout=2, read_timeout=2)
-        self.dynamodb_client = boto3.client('dynamodb', config=dynamodb_config, region_name='sa-east-1')
+        self.dynamodb_client = dynamodb_client.get_client()
 
     def load_birthdays_by_chat_id(self, chat_id: str) -> typing.List[Birthday]:
-        response = self.dynamodb_client.scan(
-            TableName=self.table_name,
-            IndexName='UserBirthdaysIndex',
-            FilterExpression='chat_id = :chat_id',
+        return sorted(self.iter_birthdays_by_chat_id(chat_id), key=lambda birthday: birthday.mmdd)
+
+    def iter_birthdays_by_chat_id(self, chat_id: str) -> typing.Iterator[Birthday]:
+        # The chat is the table's partition, its pages are read one at a time
+        items = self._query(
+            KeyConditionExpression='chat_id = :chat_id',
             ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({
                 ':chat_id': chat_id
             })
         )
-        birthdays: typing.List[Birthday] = []
-        for item in response['Items']:
-            item = utils.dynamo_obj_to_python_obj(item)
-            date_str = "/".join([
-                str(item[k]) for k in ['birthday_day', 'birthday_month', 'birthday_year']
-                if k in item and item[k] is not None
-            ])
-            birthdays.append(Birthday(item['name'], date_str))
-
-        sorted_birthdays = sorted(birthdays, key=lambda day: (day.month, day.day))
-
-        return sorted_birthdays
+        for item in items:
+            yield dynamo_codec.birthday_from_item(item)
+
+    def load_birthdays_by_day(self, day: datetime.date) -> typing.Iterator[typing.Tuple[str, Birthday]]:
+        for month, day_of_month in utils.birthday_days(day):
+            for item in self._query_day(month, day_of_month):
+                yield item['chat_id']['S'], dynamo_codec.birthday_from_item(item)
+
+    def load_birthdays_by_days(
+            self, days: typing.Iterable[datetime.date]
+    ) -> typing.List[typing.Tuple[datetime.date, str, Birthday]]:
+        # One index query per distinct day of the year, run concurrently
+        dates_by_day = _dates_by_birthday_day(days)
+        if len(dates_by_day) == 0:
+            return []
+        birthdays: typing.List[typing.Tuple[datetime.date, str, Birthday]] = []
+        with futures.ThreadPoolExecutor(max_workers=min(self.QUERY_WORKERS, len(dates_by_day))) as executor:
+            results = executor.map(lambda month_day: list(self._query_day(*month_day)), dates_by_day)
+            for dates, items in zip(dates_by_day.values(), results):
+                for item in items:
+                    chat_id, birthday = item['chat_id']['S'], dynamo_codec.birthday_from_item(item)
+                    birthdays += [(date, chat_id, birthday) for date in dates]
+        return birthdays
 
-    def load_birthdays_by_day(self, day: datetime.date) -> typing.List[typing.Tuple[str, Birthday]]:
-        response = self.dynamodb_client.scan(
-            TableName=self.table_name,
-            FilterExpression='birthday_day = :day AND birthday_month = :month',
+    def _query_day(self, month: int, day: int) -> typing.Iterator[dict]:
+        return self._query(
+            IndexName='BirthdayIndex',
+            KeyConditionExpression='birthday_month = :month AND birthday_day = :day',
             ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({
-                ':day': day.day,
-                ':month': day.month,
+                ':day': day,
+                ':month': month,
             })
         )
-        birthdays: typing.List[typing.Tuple[str, Birthday]] = []
-        for item in response['Items']:
-            item = utils.dynamo_obj_to_python_obj(item)
-            date_str = "/".join([
-                str(item[k]) for k in ['birthday_day', 'birthday_month', 'birthday_year']
-                if k in item and item[k] is not None
-            ])
-            birthdays.append((item['chat_id'], Birthday(item['name'], date_str)))
+
+    def _query(self, **kwargs) -> typing.Iterator[dict]:
+        # A single query response is capped at 1 MB, so keep following LastEvaluatedKey until exhausted
+        while True:
+            response = self.dynamodb_client.query(TableName=self.table_name, **kwargs)
+            yield from response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def load_upcoming(self, chat_id: str, start: datetime.date, days: int) -> typing.List[Birthday]:
+        birthdays: typing.List[Birthday] = []
+        for low, high in utils.upcoming_ranges(start, days):
+            items = self._query(
+                IndexName='UpcomingBirthdaysIndex',
+                KeyConditionExpression='chat_id = :chat_id AND birthday_mmdd BETWEEN :low AND :high',
+                ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({
+                    ':chat_id': chat_id,
+                    ':low': low,
+                    ':high': high,
+                })
+            )
+            range_birthdays = [dynamo_codec.birthday_from_item(item) for item in items]
+            # The index orders by MMDD only, names sharing a day come back in arbitrary order
+            birthdays += sorted(range_birthdays, key=lambda b: (b.mmdd, b.name))
         return birthdays
 
-    def store_birthday(self, chat_id: str, birthday: Birthday):
-        response = self.dynamodb_client.get_item(
+    def load_birthdays_page(
+            self, chat_id: str, cursor: typing.Optional[str], limit: int
+    ) -> typing.Tuple[typing.List[Birthday], typing.Optional[str]]:
+        # Pages follow UpcomingBirthdaysIndex order. Cursors are {mmdd}:{name} of the last birthday returned,
+        # which is all of its index key, so the next page is a query starting right after it.
+        kwargs = {
+            'IndexName': 'UpcomingBirthdaysIndex',
+            'KeyConditionExpression': 'chat_id = :chat_id',
+            'ExpressionAttributeValues': {':chat_id': {'S': chat_id}},
+            'Limit': limit + 1,
+        }
+        if cursor:
+            mmdd, name = cursor.split(":", 1)
+            kwargs['ExclusiveStartKey'] = {
+                'chat_id': {'S': chat_id},
+                'name': {'S': name},
+                'birthday_mmdd': {'N': mmdd},
+            }
+        items = list(itertools.islice(self._query(**kwargs), limit + 1))
+        birthdays = [dynamo_codec.birthday_from_item(item) for item in items[:limit]]
+        if len(items) > limit:
+            return birthdays, "{}:{}".format(birthdays[-1].mmdd, birthdays[-1].name)
+        return birthdays, None
+
+    def store_birthday(self, chat_id: str, birthday: Birthday) -> typing.Optional[Birthday]:
+        # put_item replaces the whole item, which is an upsert for this schema
+        response = self.dynamodb_client.put_item(
             TableName=self.table_name,
-            Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id, 'name': birthday.name})
+            Item=dynamo_codec.birthday_to_item(chat_id, birthday),
+            ReturnValues='ALL_OLD',
         )
-        if 'Item' in response:
-            self.dynamodb_client.update_item(
-                TableName=self.table_name,
-                Key=utils.python_obj_to_dynamo_obj({
-                    'chat_id': chat_id,
-                    'name': birthday.name
-                }),
-                UpdateExpression='SET birthday_day = :day, birthday_month = :month, birthday_year = :year',
-                ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({
-                    ':day': int(birthday.day),
-                    ':month': int(birthday.month),
-                    ':year': int(birthday.year) if birthday.year is not None else None
-                }),
-            )
-        else:
-            self.dynamodb_client.put_item(
-                TableName=self.table_name,
-                Item=utils.python_obj_to_dynamo_obj({
-                    'chat_id': chat_id,
-                    'name': birthday.name,
-                    'birthday_day': int(birthday.day),
-                    'birthday_month': int(birthday.month),
-                    'birthday_year': int(birthday.year) if birthday.year is not None else None
-                }),
-            )
+        return dynamo_codec.birthday_from_item(response['Attributes']) if 'Attributes' in response else None
+
+    def store_birthdays_bulk(self, chat_id: str, birthdays: typing.Iterable[Birthday]) -> int:
+        stored = 0
+        batch: typing.Dict[str, dict] = {}
+        batched_names: typing.Set[str] = set()
+        pending: typing.Set[futures.Future] = set()
+        with futures.ThreadPoolExecutor(max_workers=self.BATCH_WRITE_WORKERS) as executor:
+            for birthday in birthdays:
+                if birthday.name in batched_names:
+                    # A name repeated across batches must be written after its earlier write, so the last one wins
+                    self._wait(pending)
+                    pending = set()
+                    batched_names = set(batch)
+                # A batch can't hold two requests for the same key either, the last one replaces the first
+                batch[birthday.name] = {'PutRequest': {'Item': dynamo_codec.birthday_to_item(chat_id, birthday)}}
+                batched_names.add(birthday.name)
+                stored += 1
+                if len(batch) == self.BATCH_WRITE_SIZE:
+                    pending.add(executor.submit(self._batch_write, list(batch.values())))
+                    batch = {}
+                    if len(pending) >= 2 * self.BATCH_WRITE_WORKERS:
+                        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                        self._wait(done)
+            if batch:
+                pending.add(executor.submit(self._batch_write, list(batch.values())))
+            self._wait(pending)
+        return stored
+
+    @staticmethod
+    def _wait(pending: typing.Iterable[futures.Future]):
+        for future in futures.as_completed(pending):
+            future.result()
+
+    def _batch_write(self, requests: typing.List[dict]):
+        request_items = {self.table_name: requests}
+        for attempt in range(self.BATCH_WRITE_MAX_ATTEMPTS):
+            response = self.dynamodb_client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems') or {}
+            if not request_items:
+                return
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+        raise RuntimeError("Could not write {} birthdays after {} attempts".format(
+            len(request_items[self.table_name]), self.BATCH_WRITE_MAX_ATTEMPTS))
+
+    def backfill_upcoming_index(self) -> int:
+        # Sets birthday_mmdd on items written before UpcomingBirthdaysIndex existed
+        updated = 0
+        kwargs = {'TableName': self.table_name, 'FilterExpression': 'attribute_not_exists(birthday_mmdd)'}
+        while True:
+            response = self.dynamodb_client.scan(**kwargs)
+            for item in response['Items']:
+                item = utils.dynamo_obj_to_python_obj(item)
+                self.dynamodb_client.update_item(
+                    TableName=self.table_name,
+                    Key=utils.python_obj_to_dynamo_obj({'chat_id': item['chat_id'], 'name': item['name']}),
+                    UpdateExpression='SET birthday_mmdd = :mmdd',
+                    ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({
+                        ':mmdd': utils.mmdd(int(item['birthday_month']), int(item['birthday_day'])),
+                    }),
+                )
+                updated += 1
+            if 'LastEvaluatedKey' not in response:
+                return updated
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
     def get_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
         response = self.dynamodb_client.get_item(
@@ -231,35 +684,174 @@ class DynamoDBBirthdayStorage(BirthdayStorage):
             Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id, 'name': name})
         )
         if 'Item' in response:
-            item = utils.dynamo_obj_to_python_obj(response['Item'])
-            date_str = "/".join([
-                str(item[k]) for k in ['birthday_day', 'birthday_month', 'birthday_year']
-                if k in item and item[k] is not None
-            ])
-            return Birthday(name, date_str)
+            return dynamo_codec.birthday_from_item(response['Item'])
         else:
             return None
 
-    def delete_birthday(self, chat_id: str, name: str) -> bool:
-        response = self.dynamodb_client.get_item(
-            TableName=self.table_name,
-            Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id, 'name': name})
-        )
-        if 'Item' not in response:
-            return False
-        self.dynamodb_client.delete_item(
+    def delete_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
+        response = self.dynamodb_client.delete_item(
             TableName=self.table_name,
-            Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id, 'name': name})
+            Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id, 'name': name}),
+            ReturnValues='ALL_OLD',
         )
-        return True
+        return dynamo_codec.birthday_from_item(response['Attributes']) if 'Attributes' in response else None
+
+
+class CachingBirthdayStorage(BirthdayStorage):
+    # Read-through LRU of each chat's birthday list in front of another storage. A miss loads the whole list,
+    # which then answers the chat's gets, upcoming birthdays and first list page.
+    # Writes go to the wrapped storage and invalidate the chat's entry; entries written by other
+    # processes are only picked up once their TTL expires.
+
+    def __init__(self, storage: BirthdayStorage, ttl: float, max_entries: int, max_bytes: int):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # chat_id -> (expires_at, size in bytes, birthdays), least recently used first
+        self.entries: typing.OrderedDict[str, typing.Tuple[float, int, typing.List[Birthday]]] = collections.OrderedDict()
+        self.size = 0
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+    def load_birthdays_by_chat_id(self, chat_id: str) -> typing.List[Birthday]:
+        birthdays = self._get(chat_id)
+        if birthdays is None:
+            writes = self.writes
+            birthdays = list(self.storage.load_birthdays_by_chat_id(chat_id))
+            self._put(chat_id, birthdays, writes)
+        return list(birthdays)
+
+    def iter_birthdays_by_chat_id(self, chat_id: str) -> typing.Iterator[Birthday]:
+        birthdays = self._get(chat_id)
+        if birthdays is None:
+            return self.storage.iter_birthdays_by_chat_id(chat_id)
+        return iter(list(birthdays))
+
+    def load_birthdays_by_day(self, day: datetime.date) -> typing.Iterable[typing.Tuple[str, Birthday]]:
+        return self.storage.load_birthdays_by_day(day)
+
+    def load_birthdays_by_days(
+            self, days: typing.Iterable[datetime.date]
+    ) -> typing.Iterable[typing.Tuple[datetime.date, str, Birthday]]:
+        return self.storage.load_birthdays_by_days(days)
+
+    def load_upcoming(self, chat_id: str, start: datetime.date, days: int) -> typing.List[Birthday]:
+        return upcoming_birthdays(self.load_birthdays_by_chat_id(chat_id), start, days)
+
+    def load_birthdays_page(
+            self, chat_id: str, cursor: typing.Optional[str], limit: int
+    ) -> typing.Tuple[typing.List[Birthday], typing.Optional[str]]:
+        # Cursors belong to the wrapped storage: only a first page that holds the whole chat is answered here
+        if cursor is None:
+            birthdays = self.load_birthdays_by_chat_id(chat_id)
+            if len(birthdays) <= limit:
+                return sorted(birthdays, key=lambda b: (b.mmdd, b.name)), None
+        return self.storage.load_birthdays_page(chat_id, cursor, limit)
+
+    def store_birthday(self, chat_id: str, birthday: Birthday) -> typing.Optional[Birthday]:
+        try:
+            return self.storage.store_birthday(chat_id, birthday)
+        finally:
+            self.invalidate(chat_id)
+
+    def store_birthdays_bulk(self, chat_id: str, birthdays: typing.Iterable[Birthday]) -> int:
+        try:
+            return self.storage.store_birthdays_bulk(chat_id, birthdays)
+        finally:
+            self.invalidate(chat_id)
+
+    def get_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
+        # The wrapped storages (Redis, DynamoDB) match names exactly
+        for birthday in self.load_birthdays_by_chat_id(chat_id):
+            if birthday.name == name:
+                return birthday
+        return None
+
+    def delete_birthday(self, chat_id: str, name: str) -> typing.Optional[Birthday]:
+        try:
+            return self.storage.delete_birthday(chat_id, name)
+        finally:
+            self.invalidate(chat_id)
+
+    def invalidate(self, chat_id: str):
+        with self.lock:
+            self.writes += 1
+            entry = self.entries.pop(chat_id, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def _get(self, chat_id: str) -> typing.Optional[typing.List[Birthday]]:
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[2]
+
+    def _put(self, chat_id: str, birthdays: typing.List[Birthday], writes: int):
+        size = _estimate_size(birthdays)
+        with self.lock:
+            if writes != self.writes or size > self.max_bytes:
+                # A write may have landed while the list was being loaded, so it could already be stale
+                return
+            previous = self.entries.pop(chat_id, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[chat_id] = (time.monotonic() + self.ttl, size, birthdays)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+def upcoming_birthdays(birthdays: typing.Iterable[Birthday], start: datetime.date, days: int) -> typing.List[Birthday]:
+    by_day = sorted(birthdays, key=lambda b: (b.mmdd, b.name))
+    keys = [b.mmdd for b in by_day]
+    return [
+        birthday
+        for low, high in utils.upcoming_ranges(start, days)
+        for birthday in by_day[bisect.bisect_left(keys, low):bisect.bisect_right(keys, high)]
+    ]
+
+
+def _dates_by_birthday_day(
+        days: typing.Iterable[datetime.date]
+) -> typing.Dict[typing.Tuple[int, int], typing.List[datetime.date]]:
+    # (month, day) index entries to read for the dates, with the dates each one answers: Feb 29 answers Feb 28
+    # of non-leap years, and dates a year apart share their entry
+    dates_by_day: typing.Dict[typing.Tuple[int, int], typing.List[datetime.date]] = {}
+    for date in sorted(set(days)):
+        for month_day in utils.birthday_days(date):
+            dates_by_day.setdefault(month_day, []).append(date)
+    return dates_by_day
+
+
+def _estimate_size(birthdays: typing.List[Birthday]) -> int:
+    return sys.getsizeof(birthdays) + sum(sys.getsizeof(b) + sys.getsizeof(b.name) for b in birthdays)
 
 
 def build_storage(storage_type: str) -> BirthdayStorage:
     if storage_type == "Memory":
         return MemoryBirthdayStorage()
     if storage_type == "Redis":
-        return RedisBirthdayStorage(**{"host": os.getenv('REDIS_HOST'), "port": os.getenv('REDIS_PORT'), "db": 0})
-    if storage_type == "DynamoDB":
-        return DynamoDBBirthdayStorage(table_name=os.getenv('BIRTHDAYS_TABLE_NAME'))
+        storage = RedisBirthdayStorage(client=redis_client.get_client())
+    elif storage_type == "DynamoDB":
+        storage = DynamoDBBirthdayStorage(table_name=os.getenv('BIRTHDAYS_TABLE_NAME'))
     else:
         raise ValueError(f"Unknown storage type: {storage_type}")
+    if BIRTHDAY_CACHE_TTL > 0:
+        return CachingBirthdayStorage(
+            storage,
+            ttl=BIRTHDAY_CACHE_TTL,
+            max_entries=BIRTHDAY_CACHE_MAX_ENTRIES,
+            max_bytes=BIRTHDAY_CACHE_MAX_BYTES,
+        )
+    return storage
@@ -1,8 +1,17 @@
 import os
 import telebot
 
+from src import metrics
+
 TOKEN = os.getenv('TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # e.g. a local fake Bot API server
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip("/") + "/file/bot{0}/{1}"
+
 bot = telebot.TeleBot(TOKEN, threaded=False)
+metrics.instrument_bot(bot)
 
 commands = [
     {
@@ -29,8 +38,24 @@ commands = [
         "command": "listupcoming (<n>)",
         "description": "List all upcoming birthdays up to <n> days from now. Default is 14 days"
     },
+    {
+        "command": "import",
+        "description": "Import birthdays from CSV (name,date), vCard or iCalendar lines or an attached file"
+    },
+    {
+        "command": "export",
+        "description": "Export your birthdays as a CSV file"
+    },
     {
         "command": "setreminderhour <hour>",
-        "description": "Set <hour> for the reminder hour of the day (in UTC)"
+        "description": "Set <hour> for the reminder hour of the day (in your timezone, UTC by default)"
+    },
+    {
+        "command": "setreminderdays <days>",
+        "description": "Set how many days before a birthday to remind you, e.g. 7 1 0. Default is 0, the day itself"
+    },
+    {
+        "command": "settimezone <timezone>",
+        "description": "Set your timezone as an IANA name, e.g. America/Montevideo"
     }
 ]
@@ -6,6 +6,8 @@ parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
 from src.bot import bot, commands
+from src.birthday_storage import build_storage as build_birthday_storage, DynamoDBBirthdayStorage, RedisBirthdayStorage
+from src import birthday_files, polling, redis_client
 
 
 def main():
@@ -14,10 +16,52 @@ def main():
         bot.remove_webhook()
         bot.set_webhook(url=args[1])
 
+    elif len(args) > 0 and args[0] == 'poll':
+        import src.handlers  # for side effects
+        # Telegram refuses getUpdates while a webhook is set
+        bot.remove_webhook()
+        poller = polling.Poller(bot, workers=int(args[1]) if len(args) > 1 else polling.POLL_WORKERS)
+        try:
+            poller.run()
+        except KeyboardInterrupt:
+            pass
+        print("Handled {} updates".format(poller.handled))
+
     elif len(args) > 0 and args[0] == 'set-commands':
         bot.set_my_commands(commands)
+
+    elif len(args) > 0 and args[0] == 'migrate-redis':
+        birthday_storage = RedisBirthdayStorage(client=redis_client.get_client())
+        migrated = birthday_storage.migrate_legacy_keys()
+        print("Migrated {} birthdays".format(migrated))
+
+    elif len(args) > 0 and args[0] == 'migrate-dynamodb':
+        birthday_storage = DynamoDBBirthdayStorage(table_name=os.getenv('BIRTHDAYS_TABLE_NAME'))
+        updated = birthday_storage.backfill_upcoming_index()
+        print("Indexed {} birthdays".format(updated))
+
+    elif len(args) > 2 and args[0] == 'import':
+        chat_id, path = args[1], args[2]
+        birthday_storage = build_birthday_storage(os.getenv('STORAGE_TYPE'))
+        invalid_lines = []
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            stored = birthday_storage.store_birthdays_bulk(chat_id, birthday_files.read_birthdays(f, invalid_lines))
+        print("Imported {} birthdays".format(stored))
+        if len(invalid_lines) > 0:
+            print("Skipped invalid lines: {}".format(", ".join(str(line_number) for line_number in invalid_lines)))
+
+    elif len(args) > 1 and args[0] == 'export':
+        chat_id = args[1]
+        birthday_storage = build_birthday_storage(os.getenv('STORAGE_TYPE'))
+        output = open(args[2], "w", encoding="utf-8", newline="") if len(args) > 2 else sys.stdout
+        try:
+            output.writelines(birthday_files.write_csv(birthday_storage.iter_birthdays_by_chat_id(chat_id)))
+        finally:
+            if output is not sys.stdout:
+                output.close()
     else:
-        print("Invalid command. Use 'set-webhook' or 'set-commands'")
+        print("Invalid command. Use 'set-webhook', 'poll (<workers>)', 'set-commands', 'migrate-redis', 'migrate-dynamodb', "
+              "'import <chat_id> <file>' or 'export <chat_id> (<file>)'")
 
 
 if __name__ == '__main__':
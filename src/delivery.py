@@ -0,0 +1,143 @@
+import dataclasses
+import logging
+import os
+import threading
+import time
+import typing
+
+from concurrent import futures
+
+logger = logging.getLogger("root")
+logging.getLogger().setLevel(logging.INFO)
+
+# Telegram allows ~30 messages per second overall and 1 message per second to the same chat
+GLOBAL_RATE = float(os.getenv('DELIVERY_GLOBAL_RATE', '30'))
+CHAT_RATE = float(os.getenv('DELIVERY_CHAT_RATE', '1'))
+MAX_WORKERS = int(os.getenv('DELIVERY_MAX_WORKERS', '8'))
+MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', '3'))
+RETRY_BACKOFF = 0.5
+
+SENT = "sent"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+@dataclasses.dataclass
+class DeliverySummary:
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    skipped: int = 0
+
+    def add(self, other: 'DeliverySummary'):
+        self.sent += other.sent
+        self.failed += other.failed
+        self.retried += other.retried
+        self.skipped += other.skipped
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.updated_at:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.updated_at - now
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # Holds every caller back for `seconds`, as requested by a 429 retry_after
+        with self.lock:
+            self.tokens = 0
+            self.updated_at = max(self.updated_at, time.monotonic() + seconds)
+
+
+class Delivery:
+
+    def __init__(
+            self,
+            # Returning False means the message was deliberately not sent, e.g. it was already delivered
+            send: typing.Callable[[str, str], typing.Optional[bool]],
+            max_workers: int = MAX_WORKERS,
+            max_retries: int = MAX_RETRIES,
+            global_rate: float = GLOBAL_RATE,
+            chat_rate: float = CHAT_RATE,
+    ):
+        self.send = send
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.chat_buckets: typing.Dict[str, TokenBucket] = {}
+        self.chat_buckets_lock = threading.Lock()
+
+    def deliver(self, messages: typing.Iterable[typing.Tuple[str, str]]) -> DeliverySummary:
+        summary = DeliverySummary()
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for status, retries in executor.map(lambda message: self._deliver_one(*message), messages):
+                if status == SENT:
+                    summary.sent += 1
+                elif status == SKIPPED:
+                    summary.skipped += 1
+                else:
+                    summary.failed += 1
+                summary.retried += retries
+        return summary
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        with self.chat_buckets_lock:
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(rate=self.chat_rate, capacity=1)
+            return self.chat_buckets[chat_id]
+
+    def _deliver_one(self, chat_id: str, text: str) -> typing.Tuple[str, int]:
+        chat_bucket = self._chat_bucket(chat_id)
+        retries = 0
+        while True:
+            chat_bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                if self.send(chat_id, text) is False:
+                    return SKIPPED, retries
+                return SENT, retries
+            except Exception as e:
+                # Bot API errors (telebot's ApiTelegramException) carry an error_code, network errors don't
+                error_code = getattr(e, 'error_code', None)
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    # Flood limits are reported per bot, so everyone waits and not only this chat
+                    self.global_bucket.pause(retry_after)
+                    chat_bucket.pause(retry_after)
+                elif error_code is not None and error_code < 500:
+                    logger.error("Could not deliver reminder to {}: {}".format(chat_id, e))
+                    return FAILED, retries
+                else:
+                    retry_after = RETRY_BACKOFF * 2 ** retries
+                error = e
+            if retries >= self.max_retries:
+                logger.error("Could not deliver reminder to {} after {} retries: {}".format(chat_id, retries, error))
+                return FAILED, retries
+            retries += 1
+            time.sleep(retry_after)
+
+
+def _retry_after(e: Exception) -> typing.Optional[float]:
+    if getattr(e, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(e, 'result_json', None) or {}).get('parameters') or {}
+    return float(parameters.get('retry_after', 1))
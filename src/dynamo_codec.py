@@ -0,0 +1,71 @@
+import typing
+
+from src import birthday_storage, scheduling, user_storage
+
+# Maps the Birthdays and Users table items straight to objects and back. The schemas are known, so the
+# attribute values are read by type tag instead of going through boto3's generic (de)serializers, and
+# birthdays are built from their parts instead of a formatted date string.
+
+
+def _optional_int(value: typing.Optional[dict]) -> typing.Optional[int]:
+    # Missing attributes and NULL values (written for birthdays without a year) are both None
+    if value is None or 'N' not in value:
+        return None
+    return int(value['N'])
+
+
+def _optional_str(value: typing.Optional[dict]) -> typing.Optional[str]:
+    if value is None or 'S' not in value:
+        return None
+    return value['S']
+
+
+def birthday_from_item(item: dict) -> "birthday_storage.Birthday":
+    return birthday_storage.Birthday.from_parts(
+        item['name']['S'],
+        int(item['birthday_day']['N']),
+        int(item['birthday_month']['N']),
+        _optional_int(item.get('birthday_year')),
+    )
+
+
+def birthday_to_item(chat_id: str, birthday: "birthday_storage.Birthday") -> dict:
+    return {
+        'chat_id': {'S': chat_id},
+        'name': {'S': birthday.name},
+        'birthday_day': {'N': str(birthday.day)},
+        'birthday_month': {'N': str(birthday.month)},
+        'birthday_year': {'N': str(birthday.year)} if birthday.year is not None else {'NULL': True},
+        'birthday_mmdd': {'N': str(birthday.mmdd)},
+    }
+
+
+def user_from_item(item: dict) -> "user_storage.User":
+    return user_storage.User(
+        chat_id=item['chat_id']['S'],
+        user_name=_optional_str(item.get('user_name')),
+        first_name=_optional_str(item.get('first_name')),
+        last_name=_optional_str(item.get('last_name')),
+        reminder_hour=int(item['reminder_hour']['N']),
+        timezone=_optional_str(item.get('timezone')) or scheduling.DEFAULT_TIMEZONE,
+        local_reminder_hour=_optional_int(item.get('local_reminder_hour')),
+        reminder_offsets=[int(value['N']) for value in item['reminder_offsets']['L']]
+        if 'reminder_offsets' in item else None,
+    )
+
+
+def user_to_item(user: "user_storage.User") -> dict:
+    return {
+        'chat_id': {'S': user.chat_id},
+        'user_name': {'S': str(user.user_name)},
+        'first_name': {'S': str(user.first_name)},
+        'last_name': {'S': str(user.last_name)},
+        'reminder_hour': {'N': str(int(user.reminder_hour))},
+        'timezone': {'S': user.timezone},
+        'local_reminder_hour': {'N': str(int(user.local_hour()))},
+        'reminder_offsets': offsets_to_attribute(user.reminder_offsets),
+    }
+
+
+def offsets_to_attribute(reminder_offsets: typing.List[int]) -> dict:
+    return {'L': [{'N': str(int(offset))} for offset in reminder_offsets]}
@@ -0,0 +1,20 @@
+import functools
+import typing
+
+from src import metrics
+
+if typing.TYPE_CHECKING:
+    from botocore import client as botocore_client
+
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> "botocore_client.BaseClient":
+    # One client per process, shared by every storage. boto3 is imported here so that only the
+    # deployments using DynamoDB pay for it.
+    import boto3
+    from botocore import config as botocore_config
+
+    dynamodb_config = botocore_config.Config(connect_timeout=2, read_timeout=2)
+    client = boto3.client('dynamodb', config=dynamodb_config, region_name='sa-east-1')
+    metrics.instrument_dynamodb(client)
+    return client
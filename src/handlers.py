@@ -1,51 +1,72 @@
 import sys
 import os
+import io
+import dataclasses
+import itertools
+import tempfile
 import logging
 import datetime
+import typing
+
+from telebot import types
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
-from src.birthday_storage import build_storage as build_birthday_storage, Birthday
-from src.user_storage import build_storage as build_user_storage, User
+from src.birthday_storage import Birthday
+from src.user_storage import User
 from src.bot import commands, bot
-from src import utils
-
-USERS_TABLE_NAME = os.getenv('USERS_TABLE_NAME')
-STORAGE_TYPE = os.getenv('STORAGE_TYPE')
-
-birthday_storage = build_birthday_storage(storage_type=STORAGE_TYPE)
-user_storage = build_user_storage(storage_type=STORAGE_TYPE)
+from src import birthday_files, metrics, reminder_plan, replies, scheduling, services, utils
 
 logger = logging.getLogger("root")
 logging.getLogger().setLevel(logging.INFO)
 
+MAX_IMPORT_FILE_SIZE = 5 * 1024 * 1024
+MAX_REPORTED_INVALID_LINES = 20
+EXPORT_SPOOL_SIZE = 1024 * 1024
+LIST_PAGE_SIZE = 100
+# Telegram caps a button's callback data at 64 bytes
+MAX_CALLBACK_DATA_SIZE = 64
+MAX_REMINDER_OFFSETS = 5
+
 
 def remove_command_prefix(text: str) -> str:
     return " ".join(text.split(" ", 1)[1:]).strip()
 
 
 @bot.message_handler(commands=['start'])
+@metrics.command("start")
 def handle_start(message):
     text = "I can help you remember birthdays.\n"
     text += "You can store birthdays and I will remind you when they come.\n\n"
     text += "Use the following commands to interact with me:\n\n"
     chat_id = str(message.chat.id)
-    user = User(
-        chat_id=chat_id,
-        user_name=message.from_user.username,
-        first_name=message.from_user.first_name,
-        last_name=message.from_user.last_name,
-        reminder_hour=0,
-    )
-    user_storage.store_user(user)
+    user = services.user_storage().get_user(chat_id)
+    if user is None:
+        user = User(
+            chat_id=chat_id,
+            user_name=message.from_user.username,
+            first_name=message.from_user.first_name,
+            last_name=message.from_user.last_name,
+            reminder_hour=0,
+        )
+    else:
+        # Only the names are refreshed, the reminder settings and the slot stay as they are
+        user = dataclasses.replace(
+            user,
+            user_name=message.from_user.username,
+            first_name=message.from_user.first_name,
+            last_name=message.from_user.last_name,
+        )
+    services.user_storage().store_user(user)
     for command in commands:
         text += "/{} - {}\n".format(command["command"], command["description"])
-    bot.send_message(chat_id=message.chat.id, text=text)
+    replies.send_message(chat_id=message.chat.id, text=text)
 
 
 @bot.message_handler(commands=['add'])
+@metrics.command("add")
 def handle_add(message):
     chat_id = str(message.chat.id)
     text = remove_command_prefix(message.text)
@@ -53,129 +74,278 @@ def handle_add(message):
         data_parts = text.split(" ")
         data_parts = [d for d in data_parts if d != ""]
         if len(data_parts) < 2:
-            bot.send_message(chat_id=chat_id, text="Invalid input. Please use /add <name> <date>")
+            replies.send_message(chat_id=chat_id, text="Invalid input. Please use /add <name> <date>")
             return
         person_name = " ".join([d.strip() for d in data_parts[0:len(data_parts) - 1]])
         date_str = data_parts[-1]
         birthday = Birthday(name=person_name, date_str=date_str)
-        birthday_storage.store_birthday(chat_id, birthday)
-        bot.send_message(chat_id=chat_id, text="Birthday for {} was correctly set".format(person_name))
+        previous = services.birthday_storage().store_birthday(chat_id, birthday)
+        reminder_plan.birthday_changed(chat_id, birthday, previous)
+        replies.send_message(chat_id=chat_id, text="Birthday for {} was correctly set".format(person_name))
     except ValueError:
-        bot.send_message(chat_id=chat_id, text="Invalid date format. Please use dd/mm/yyyy or dd/mm")
+        replies.send_message(chat_id=chat_id, text="Invalid date format. Please use dd/mm/yyyy or dd/mm")
 
 
 @bot.message_handler(commands=['delete'])
+@metrics.command("delete")
 def handle_delete(message):
     chat_id = str(message.chat.id)
     text = remove_command_prefix(message.text)
     if text == "":
-        bot.send_message(chat_id=chat_id, text="Invalid input. Please use /delete <name>")
+        replies.send_message(chat_id=chat_id, text="Invalid input. Please use /delete <name>")
         return
     person_name = str(text).strip()
-    deleted = birthday_storage.delete_birthday(chat_id, person_name)
-    if deleted:
-        bot.send_message(chat_id=chat_id, text="Birthday correctly deleted")
+    deleted = services.birthday_storage().delete_birthday(chat_id, person_name)
+    if deleted is not None:
+        reminder_plan.birthday_changed(chat_id, deleted)
+        replies.send_message(chat_id=chat_id, text="Birthday correctly deleted")
         return
-    bot.send_message(chat_id=chat_id, text="No birthday found for {}".format(person_name))
+    replies.send_message(chat_id=chat_id, text="No birthday found for {}".format(person_name))
 
 
 @bot.message_handler(commands=['get'])
+@metrics.command("get")
 def handle_get(message):
     chat_id = str(message.chat.id)
     text = remove_command_prefix(message.text)
     if text == "":
-        bot.send_message(chat_id=chat_id, text="Invalid input. Please use /get <name>")
+        replies.send_message(chat_id=chat_id, text="Invalid input. Please use /get <name>")
         return
     data_parts = text.split(" ")
     data_parts = [d for d in data_parts if d != ""]
     person_name = " ".join([d.strip() for d in data_parts[0:len(data_parts)]])
-    birthday = birthday_storage.get_birthday(chat_id, person_name)
+    birthday = services.birthday_storage().get_birthday(chat_id, person_name)
     if birthday is not None:
-        bot.send_message(chat_id=chat_id, text=birthday.date_format())
+        replies.send_message(chat_id=chat_id, text=birthday.date_format())
     else:
-        bot.send_message(chat_id=chat_id, text="No birthday found for {}".format(person_name))
+        replies.send_message(chat_id=chat_id, text="No birthday found for {}".format(person_name))
 
 
 @bot.message_handler(commands=['list'])
+@metrics.command("list")
 def handle_list(message):
-    chat_id = str(message.chat.id)
-    birthdays = birthday_storage.load_birthdays_by_chat_id(chat_id)
-    text = ""
-    for birthday in birthdays:
-        text += "{} - {}\n".format(birthday.name, birthday.date_format())
-    if text == "":
-        text = "No birthdays found"
-    bot.send_message(chat_id=chat_id, text=text)
+    send_list_page(str(message.chat.id), 0, None)
+
+
+@bot.callback_query_handler(func=lambda call: call.data is not None and call.data.startswith("list:"))
+@metrics.command("list")
+def handle_list_page(call):
+    # callback data is list:{offset}:{cursor}, see list_page_markup
+    _, offset, cursor = call.data.split(":", 2)
+    bot.answer_callback_query(call.id)
+    send_list_page(str(call.message.chat.id), int(offset), cursor or None)
+
+
+def send_list_page(chat_id: str, offset: int, cursor: typing.Optional[str]):
+    # offset is the number of birthdays listed before this page
+    storage = services.birthday_storage()
+    if cursor is None and offset > 0:
+        # The cursor did not fit in the button, the page is found by skipping the birthdays listed before it
+        birthdays, next_cursor = storage.load_birthdays_page(chat_id, None, offset + LIST_PAGE_SIZE)
+        birthdays = birthdays[offset:]
+    else:
+        birthdays, next_cursor = storage.load_birthdays_page(chat_id, cursor, LIST_PAGE_SIZE)
+    if len(birthdays) == 0:
+        replies.send_message(chat_id=chat_id, text="No birthdays found")
+        return
+    messages = replies.split_lines("{} - {}".format(birthday.name, birthday.date_format()) for birthday in birthdays)
+    for text in messages[:-1]:
+        replies.send_message(chat_id=chat_id, text=text)
+    if next_cursor is None:
+        replies.send_message(chat_id=chat_id, text=messages[-1])
+    else:
+        reply_markup = list_page_markup(offset + len(birthdays), next_cursor)
+        replies.send_message(chat_id=chat_id, text=messages[-1], reply_markup=reply_markup)
+
+
+def list_page_markup(offset: int, cursor: str) -> types.InlineKeyboardMarkup:
+    callback_data = "list:{}:{}".format(offset, cursor)
+    if len(callback_data.encode("utf-8")) > MAX_CALLBACK_DATA_SIZE:
+        callback_data = "list:{}:".format(offset)
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Next {}".format(LIST_PAGE_SIZE), callback_data=callback_data))
+    return markup
 
 
 @bot.message_handler(commands=['listupcoming'])
+@metrics.command("listupcoming")
 def handle_listupcoming(message):
     chat_id = str(message.chat.id)
     text = remove_command_prefix(message.text)
     if text == "":
         text = "14"
     elif not utils.represents_int(text):
-        bot.send_message(chat_id=chat_id, text="Invalid number format. Please use an integer")
+        replies.send_message(chat_id=chat_id, text="Invalid number format. Please use an integer")
         return
     elif int(text) < 0 or int(text) > 365:
-        bot.send_message(chat_id=chat_id, text="Invalid number input. Please use a integer between 0 and 365")
-        return
-
-    birthdays = birthday_storage.load_birthdays_by_chat_id(chat_id)
-
-    today = datetime.datetime.now()
-    today_plus_days = today + datetime.timedelta(days=int(text))
-
-    today_plus_days_this_year = today_plus_days
-    today_plus_days_next_year = None
-    if today_plus_days.year > today.year:
-        today_plus_days_this_year = datetime.date(year=today.year, month=12, day=31)
-        today_plus_days_next_year = today_plus_days
-
-    filtered_birthdays = [
-        b for b in birthdays
-        if all([
-            b.month > today.month
-            or (b.month == today.month and b.day >= today.day),
-            (b.month < today_plus_days_this_year.month
-             or (b.month == today_plus_days_this_year.month and b.day < today_plus_days_this_year.day))
-        ])
-    ]
-
-    if today_plus_days_next_year is not None:
-        filtered_birthdays += [
-            b for b in birthdays
-            if b.month < today_plus_days_next_year.month
-               or (b.month == today_plus_days_next_year.month and b.day < today_plus_days_next_year.day)
-        ]
-
-    text = ""
-    for birthday in filtered_birthdays:
-        text += "{} - {}\n".format(birthday.name, birthday.date_format())
-    if text == "":
-        text = "No birthdays found"
-    bot.send_message(chat_id=chat_id, text=text)
+        replies.send_message(chat_id=chat_id, text="Invalid number input. Please use a integer between 0 and 365")
+        return
+
+    # The window starts on the user's local date
+    user = services.user_storage().get_user(chat_id)
+    timezone = user.timezone if user is not None else scheduling.DEFAULT_TIMEZONE
+    today = scheduling.local_date(datetime.datetime.now(datetime.timezone.utc), timezone)
+    birthdays = services.birthday_storage().load_upcoming(chat_id, today, int(text))
+    if len(birthdays) == 0:
+        replies.send_message(chat_id=chat_id, text="No birthdays found")
+        return
+    for text in replies.split_lines("{} - {}".format(birthday.name, birthday.date_format()) for birthday in birthdays):
+        replies.send_message(chat_id=chat_id, text=text)
+
+
+@bot.message_handler(commands=['import'])
+@metrics.command("import")
+def handle_import(message):
+    chat_id = str(message.chat.id)
+    parts = message.text.split(None, 1)
+    if len(parts) < 2:
+        replies.send_message(
+            chat_id=chat_id,
+            text="Invalid input. Please use /import followed by CSV (name,date), vCard or iCalendar lines, "
+                 "or send the file with /import as caption"
+        )
+        return
+    import_birthdays(chat_id, io.StringIO(parts[1]))
+
+
+@bot.message_handler(
+    content_types=['document'],
+    func=lambda message: (message.caption or "").startswith("/import")
+)
+@metrics.command("import")
+def handle_import_file(message):
+    chat_id = str(message.chat.id)
+    if message.document.file_size is not None and message.document.file_size > MAX_IMPORT_FILE_SIZE:
+        replies.send_message(chat_id=chat_id, text="File too large. The limit is {} MB".format(MAX_IMPORT_FILE_SIZE // 1024 // 1024))
+        return
+    file_info = bot.get_file(message.document.file_id)
+    content = bot.download_file(file_info.file_path)
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        replies.send_message(chat_id=chat_id, text="Invalid file encoding. Please use UTF-8")
+        return
+    import_birthdays(chat_id, io.StringIO(text, newline=None))
+
+
+def import_birthdays(chat_id: str, lines: typing.Iterable[str]):
+    invalid_lines: typing.List[int] = []
+    birthdays = birthday_files.read_birthdays(lines, invalid_lines)
+    stored = services.birthday_storage().store_birthdays_bulk(chat_id, birthdays)
+    if stored > 0:
+        reminder_plan.replan_chat(chat_id)
+    text = "Imported {} birthdays".format(stored)
+    if len(invalid_lines) > 0:
+        text += "\nSkipped invalid lines: {}".format(
+            ", ".join(str(line_number) for line_number in invalid_lines[:MAX_REPORTED_INVALID_LINES])
+        )
+        if len(invalid_lines) > MAX_REPORTED_INVALID_LINES:
+            text += ", ..."
+    replies.send_message(chat_id=chat_id, text=text)
+
+
+@bot.message_handler(commands=['export'])
+@metrics.command("export")
+def handle_export(message):
+    chat_id = str(message.chat.id)
+    birthdays = services.birthday_storage().iter_birthdays_by_chat_id(chat_id)
+    first = next(birthdays, None)
+    if first is None:
+        replies.send_message(chat_id=chat_id, text="No birthdays found")
+        return
+    # Rows are written as the storage pages through the chat, large exports spill to disk
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as document:
+        for line in birthday_files.write_csv(itertools.chain([first], birthdays)):
+            document.write(line.encode("utf-8"))
+        document.seek(0)
+        bot.send_document(chat_id=chat_id, document=document, visible_file_name="birthdays.csv")
 
 
 @bot.message_handler(commands=['setreminderhour'])
+@metrics.command("setreminderhour")
 def handle_set_hour(message):
     chat_id = str(message.chat.id)
     text = remove_command_prefix(message.text)
     if text == "":
-        bot.send_message(chat_id=chat_id, text="Invalid input. Please use /setreminderhour <hour>")
+        replies.send_message(chat_id=chat_id, text="Invalid input. Please use /setreminderhour <hour>")
         return
     if not utils.represents_int(text):
-        bot.send_message(chat_id=chat_id, text="Invalid hour format. Please use an integer")
+        replies.send_message(chat_id=chat_id, text="Invalid hour format. Please use an integer")
         return
     if int(text) < 0 or int(text) > 23:
-        bot.send_message(chat_id=chat_id, text="Invalid hour format. Please use a integer between 0 and 23")
+        replies.send_message(chat_id=chat_id, text="Invalid hour format. Please use a integer between 0 and 23")
         return
-    user_storage.update_reminder_hour(chat_id, int(text))
+    user = services.user_storage().get_user(chat_id)
+    timezone = user.timezone if user is not None else scheduling.DEFAULT_TIMEZONE
+    update_reminder_schedule(chat_id, timezone, int(text), user)
     text = "Hour for reminder correctly set"
-    bot.send_message(chat_id=chat_id, text=text)
+    replies.send_message(chat_id=chat_id, text=text)
+
+
+@bot.message_handler(commands=['settimezone'])
+@metrics.command("settimezone")
+def handle_set_timezone(message):
+    chat_id = str(message.chat.id)
+    text = remove_command_prefix(message.text)
+    if text == "":
+        replies.send_message(chat_id=chat_id, text="Invalid input. Please use /settimezone <timezone>, e.g. America/Montevideo")
+        return
+    if not scheduling.is_valid_timezone(text):
+        replies.send_message(chat_id=chat_id, text="Unknown timezone. Please use an IANA name such as Europe/Madrid")
+        return
+    user = services.user_storage().get_user(chat_id)
+    local_hour = user.local_hour() if user is not None else 0
+    update_reminder_schedule(chat_id, text, local_hour, user)
+    replies.send_message(chat_id=chat_id, text="Timezone correctly set")
+
+
+@bot.message_handler(commands=['setreminderdays'])
+@metrics.command("setreminderdays")
+def handle_set_reminder_days(message):
+    chat_id = str(message.chat.id)
+    text = remove_command_prefix(message.text)
+    if text == "":
+        replies.send_message(chat_id=chat_id, text="Invalid input. Please use /setreminderdays <days> ..., e.g. 7 1 0")
+        return
+    days = [d for d in text.split(" ") if d != ""]
+    if not all(utils.represents_int(d) for d in days):
+        replies.send_message(chat_id=chat_id, text="Invalid days format. Please use integers")
+        return
+    offsets = sorted({int(d) for d in days}, reverse=True)
+    if offsets[0] > reminder_plan.MAX_REMINDER_DAYS or offsets[-1] < 0:
+        replies.send_message(
+            chat_id=chat_id,
+            text="Invalid days format. Please use integers between 0 and {}".format(reminder_plan.MAX_REMINDER_DAYS),
+        )
+        return
+    if len(offsets) > MAX_REMINDER_OFFSETS:
+        replies.send_message(chat_id=chat_id, text="Please use at most {} days".format(MAX_REMINDER_OFFSETS))
+        return
+    user = services.user_storage().get_user(chat_id)
+    if user is None:
+        replies.send_message(chat_id=chat_id, text="Please use /start first")
+        return
+    services.user_storage().update_reminder_offsets(chat_id, offsets)
+    reminder_plan.replan_chat(chat_id, user=dataclasses.replace(user, reminder_offsets=offsets))
+    text = "Reminders correctly set for {} days before".format(", ".join(str(offset) for offset in offsets))
+    replies.send_message(chat_id=chat_id, text=text)
+
+
+def update_reminder_schedule(chat_id: str, timezone: str, local_hour: int, user: typing.Optional[User]):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    slot = scheduling.next_reminder_slot(timezone, local_hour, now)
+    previous_hour = user.reminder_hour if user is not None else None
+    services.user_storage().update_reminder_schedule(chat_id, slot, timezone, local_hour)
+    if user is None:
+        reminder_plan.replan_chat(chat_id, now=now)
+        return
+    # Moves the chat's planned reminders to the new slot
+    user = dataclasses.replace(user, reminder_hour=slot, timezone=timezone, local_reminder_hour=local_hour)
+    reminder_plan.replan_chat(chat_id, user=user, previous_hour=previous_hour, now=now)
 
 
 @bot.message_handler(func=lambda message: True)
+@metrics.command("unknown")
 def handle_command_not_found(message):
     chat_id = str(message.chat.id)
-    bot.send_message(chat_id=chat_id, text="Command not found")
+    replies.send_message(chat_id=chat_id, text="Command not found")
@@ -0,0 +1,276 @@
+import contextlib
+import contextvars
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+import types
+import typing
+
+# In-process metrics for the hot paths: command handlers, storage methods, Bot API calls and DynamoDB
+# requests. Every metric is labelled with the command being handled, so a slow /list can be traced to the
+# storage or the Bot API. Histograms and counters accumulate for Prometheus scrapes (see prometheus_text),
+# and in Lambda the observations of each invocation are also written as CloudWatch Embedded Metric Format
+# log lines by flush_emf. Recording is a few dict operations under a lock, cheap enough to leave on.
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'BirthdayBot')
+EMF_ENABLED = os.getenv('METRICS_EMF', '1' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else '0') == '1'
+# Upper bounds in milliseconds
+LATENCY_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, math.inf)
+# An EMF line holds up to 100 values per metric, and observations past MAX_PENDING are only aggregated
+EMF_MAX_VALUES = 100
+MAX_PENDING = 1000
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DYNAMODB_CAPACITY_OPERATIONS = {
+    'BatchGetItem', 'BatchWriteItem', 'DeleteItem', 'GetItem', 'PutItem', 'Query', 'Scan', 'UpdateItem',
+}
+BOT_METHODS = ('send_message', 'send_document', 'answer_callback_query')
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+Key = typing.Tuple[str, Labels]
+
+_command: contextvars.ContextVar[str] = contextvars.ContextVar('command', default='none')
+_lock = threading.Lock()
+# key -> [bucket counts, sum]
+_histograms: typing.Dict[Key, list] = {}
+_counters: typing.Dict[Key, float] = {}
+# Observations and counter increments since the last flush_emf
+_pending_observations: typing.Dict[Key, typing.List[float]] = {}
+_pending_counts: typing.Dict[Key, float] = {}
+
+
+def _key(name: str, labels: typing.Dict[str, str]) -> Key:
+    labels['command'] = _command.get()
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name: str, value: float, **labels: str):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        if EMF_ENABLED:
+            pending = _pending_observations.setdefault(key, [])
+            if len(pending) < MAX_PENDING:
+                pending.append(value)
+
+
+def increment(name: str, value: float = 1, **labels: str):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        if EMF_ENABLED:
+            _pending_counts[key] = _pending_counts.get(key, 0) + value
+
+
+def _elapsed_ms(started: float) -> float:
+    return (time.perf_counter() - started) * 1000
+
+
+@contextlib.contextmanager
+def command_context(name: str) -> typing.Iterator[None]:
+    token = _command.set(name)
+    try:
+        yield
+    finally:
+        _command.reset(token)
+
+
+def command(name: str) -> typing.Callable:
+    # Decorates a handler, goes below the bot's handler decorator so the timed function is the one registered
+    def decorator(function: typing.Callable) -> typing.Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            with command_context(name):
+                try:
+                    return function(*args, **kwargs)
+                except Exception:
+                    increment('command_errors_total')
+                    raise
+                finally:
+                    observe('command_latency_ms', _elapsed_ms(started))
+        return wrapper
+    return decorator
+
+
+class InstrumentedStorage:
+    # Proxies a storage, timing every public method and counting the items it returns. Lazily consumed
+    # results (generators) are timed while they are iterated, without the time spent by the consumer.
+
+    def __init__(self, storage: typing.Any, name: str):
+        self._storage = storage
+        self._name = name
+
+    def __getattr__(self, attribute: str) -> typing.Any:
+        value = getattr(self._storage, attribute)
+        if attribute.startswith("_") or not callable(value):
+            return value
+        wrapper = functools.partial(self._call, attribute, value)
+        # Later lookups find the wrapper in the instance dict and skip __getattr__
+        self.__dict__[attribute] = wrapper
+        return wrapper
+
+    def _call(self, method: str, function: typing.Callable, *args, **kwargs) -> typing.Any:
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self._record(method, _elapsed_ms(started), 0, error=True)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return self._iterate(method, result, _elapsed_ms(started))
+        self._record(method, _elapsed_ms(started), _count_items(result))
+        return result
+
+    def _iterate(self, method: str, result: typing.Iterator, elapsed_ms: float) -> typing.Iterator:
+        items = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(result)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed_ms += _elapsed_ms(started)
+                items += 1
+                yield item
+        finally:
+            self._record(method, elapsed_ms, items)
+
+    def _record(self, method: str, elapsed_ms: float, items: int, error: bool = False):
+        observe('storage_latency_ms', elapsed_ms, storage=self._name, method=method)
+        if items > 0:
+            increment('storage_items_total', items, storage=self._name, method=method)
+        if error:
+            increment('storage_errors_total', storage=self._name, method=method)
+
+
+def _count_items(result: typing.Any) -> int:
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and len(result) > 0 and isinstance(result[0], list):
+        # A page and its cursor
+        return len(result[0])
+    if result is None or isinstance(result, (bool, int)):
+        return 0
+    return 1
+
+
+def instrument_bot(bot: typing.Any):
+    # Replaces the bot's outbound calls with timed ones
+    for method in BOT_METHODS:
+        setattr(bot, method, _timed_bot_method(method, getattr(bot, method)))
+
+
+def _timed_bot_method(method: str, function: typing.Callable) -> typing.Callable:
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            increment('telegram_errors_total', method=method)
+            raise
+        finally:
+            observe('telegram_latency_ms', _elapsed_ms(started), method=method)
+    return wrapper
+
+
+def instrument_dynamodb(client: typing.Any):
+    # Asks every request for its consumed capacity and records it with the items read per operation
+    client.meta.events.register('provide-client-params.dynamodb', _request_consumed_capacity)
+    client.meta.events.register('after-call.dynamodb', _record_dynamodb_call)
+
+
+def _request_consumed_capacity(params: dict, model: typing.Any, **kwargs):
+    if model.name in DYNAMODB_CAPACITY_OPERATIONS:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+
+def _record_dynamodb_call(parsed: dict, model: typing.Any, **kwargs):
+    increment('dynamodb_calls_total', operation=model.name)
+    consumed = parsed.get('ConsumedCapacity') or []
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    capacity = sum(entry.get('CapacityUnits', 0) for entry in consumed)
+    if capacity > 0:
+        increment('dynamodb_consumed_capacity_total', capacity, operation=model.name)
+    if parsed.get('Count'):
+        increment('dynamodb_items_total', parsed['Count'], operation=model.name)
+
+
+def flush_emf(stream: typing.TextIO = sys.stdout):
+    # Writes what was recorded since the last flush as EMF lines, called at the end of each Lambda invocation
+    if not EMF_ENABLED:
+        return
+    with _lock:
+        observations, counts = dict(_pending_observations), dict(_pending_counts)
+        _pending_observations.clear()
+        _pending_counts.clear()
+    timestamp = int(time.time() * 1000)
+    for (name, labels), values in observations.items():
+        for first in range(0, len(values), EMF_MAX_VALUES):
+            stream.write(_emf_line(timestamp, name, labels, 'Milliseconds', values[first:first + EMF_MAX_VALUES]))
+    for (name, labels), value in counts.items():
+        stream.write(_emf_line(timestamp, name, labels, 'Count', value))
+    stream.flush()
+
+
+def _emf_line(timestamp: int, name: str, labels: Labels, unit: str, value: typing.Any) -> str:
+    return json.dumps({
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [[label for label, _ in labels]],
+                'Metrics': [{'Name': name, 'Unit': unit}],
+            }],
+        },
+        **dict(labels),
+        name: value,
+    }) + "\n"
+
+
+def prometheus_text() -> str:
+    with _lock:
+        histograms = {key: (list(counts), total) for key, (counts, total) in _histograms.items()}
+        counters = dict(_counters)
+    lines: typing.List[str] = []
+    typed: typing.Set[str] = set()
+    for (name, labels), (counts, total) in sorted(histograms.items()):
+        if name not in typed:
+            lines.append("# TYPE {} histogram".format(name))
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else "{:g}".format(bound)
+            lines.append("{}_bucket{} {}".format(name, _prometheus_labels(labels + (('le', le),)), cumulative))
+        lines.append("{}_sum{} {}".format(name, _prometheus_labels(labels), total))
+        lines.append("{}_count{} {}".format(name, _prometheus_labels(labels), cumulative))
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append("# TYPE {} counter".format(name))
+            typed.add(name)
+        lines.append("{}{} {}".format(name, _prometheus_labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+def _prometheus_labels(labels: Labels) -> str:
+    escaped = (
+        '{}="{}"'.format(label, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
@@ -0,0 +1,139 @@
+import logging
+import os
+import queue
+import threading
+import typing
+import zlib
+
+if typing.TYPE_CHECKING:
+    import telebot
+
+logger = logging.getLogger("root")
+logging.getLogger().setLevel(logging.INFO)
+
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', '16'))
+# Telegram returns at most 100 updates per getUpdates call
+POLL_LIMIT = int(os.getenv('POLL_LIMIT', '100'))
+# Seconds a getUpdates call waits for updates before returning an empty batch
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '50'))
+POLL_ALLOWED_UPDATES = ["message", "callback_query"]
+MAX_RETRY_BACKOFF = 30
+
+
+def update_chat_id(update: "telebot.types.Update") -> int:
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return update.update_id
+
+
+def worker_index(update: "telebot.types.Update", workers: int) -> int:
+    return zlib.crc32(str(update_chat_id(update)).encode("utf-8")) % workers
+
+
+class ChatDispatcher:
+    # Hands updates to a pool of worker threads. Each worker owns a queue and every chat is always routed to
+    # the same one, so a chat's updates are handled in order while different chats are handled concurrently.
+
+    def __init__(self, bot: "telebot.TeleBot", workers: int, queue_size: int = 0, name: str = "worker"):
+        self.bot = bot
+        # queue_size bounds the updates waiting across all the workers, 0 leaves them unbounded
+        maxsize = max(1, queue_size // workers) if queue_size > 0 else 0
+        self.queues: typing.List[queue.Queue] = [queue.Queue(maxsize=maxsize) for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self._work, args=(q,), name="{}-{}".format(name, i), daemon=True)
+            for i, q in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, update: "telebot.types.Update", block: bool = True) -> bool:
+        # False when the chat's queue is full and block is False
+        try:
+            self.queues[worker_index(update, len(self.queues))].put(update, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        # Waits until every submitted update was handled
+        for q in self.queues:
+            q.join()
+
+    def _work(self, q: queue.Queue):
+        while True:
+            update = q.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error("An error occurred while processing the update {}: {}".format(update.update_id, e))
+            finally:
+                q.task_done()
+
+
+class Poller:
+    # Long polls getUpdates and hands each batch to a ChatDispatcher. The offset that confirms a batch to
+    # Telegram is only sent with the next getUpdates call, once the whole batch was handled: a batch that was
+    # in flight when the process died is fetched again on restart.
+
+    def __init__(
+            self,
+            bot: "telebot.TeleBot",
+            workers: int = POLL_WORKERS,
+            limit: int = POLL_LIMIT,
+            timeout: int = POLL_TIMEOUT,
+    ):
+        self.bot = bot
+        self.limit = limit
+        self.timeout = timeout
+        self.dispatcher = ChatDispatcher(bot, workers, name="poll")
+        self.stopped = threading.Event()
+        self.offset: typing.Optional[int] = None
+        self.handled = 0
+
+    def run(self):
+        self.dispatcher.start()
+        retries = 0
+        while not self.stopped.is_set():
+            try:
+                updates = self.bot.get_updates(
+                    offset=self.offset,
+                    limit=self.limit,
+                    timeout=self.timeout,
+                    long_polling_timeout=self.timeout,
+                    allowed_updates=POLL_ALLOWED_UPDATES,
+                )
+            except Exception as e:
+                backoff = min(MAX_RETRY_BACKOFF, 2 ** retries)
+                logger.error("Could not get updates, retrying in {}s: {}".format(backoff, e))
+                retries += 1
+                self.stopped.wait(backoff)
+                continue
+            retries = 0
+            if len(updates) > 0:
+                self.handle_batch(updates)
+        self._confirm()
+
+    def stop(self):
+        # The batch being handled is finished and confirmed before run returns
+        self.stopped.set()
+
+    def handle_batch(self, updates: typing.List["telebot.types.Update"]):
+        for update in updates:
+            self.dispatcher.submit(update)
+        self.dispatcher.join()
+        self.offset = updates[-1].update_id + 1
+        self.handled += len(updates)
+
+    def _confirm(self):
+        # Without it the last batch would be fetched again by the next poller. The updates returned here are
+        # not handled and thus not confirmed either.
+        if self.offset is None:
+            return
+        try:
+            self.bot.get_updates(offset=self.offset, limit=1, timeout=1, long_polling_timeout=1)
+        except Exception as e:
+            logger.error("Could not confirm updates up to {}: {}".format(self.offset, e))
@@ -0,0 +1,167 @@
+import datetime
+import logging
+import typing
+
+from src.birthday_storage import Birthday
+from src.user_storage import User
+from src import scheduling, services, utils
+
+logger = logging.getLogger("root")
+logging.getLogger().setLevel(logging.INFO)
+
+# The reminders of a UTC day are planned once, before the day starts: each hourly slot gets the entries of
+# the chats it has to handle, so its run reads one item instead of joining the slot's users with the
+# birthdays of their local dates. An entry is {"day": local date, "names": [...], "ahead": {days: [...]}}
+# for a chat to remind of the birthdays of that day and of those `days` ahead (the user's reminder
+# offsets), plus "slot" when the user moves to another slot afterwards (DST). Changes made after planning
+# patch the planned slots of the chat, and a slot that was not planned falls back to the join.
+
+Entry = typing.Dict[str, typing.Any]
+
+# Largest reminder offset a user can set, in days
+MAX_REMINDER_DAYS = 60
+
+
+def slot_start(day: datetime.date, hour: int) -> datetime.datetime:
+    return datetime.datetime.combine(day, datetime.time(hour), tzinfo=datetime.timezone.utc)
+
+
+def has_run(day: datetime.date, hour: int, now: datetime.datetime) -> bool:
+    return slot_start(day, hour) + datetime.timedelta(hours=1) <= now
+
+
+def plan_entry(
+        user: User,
+        now: datetime.datetime,
+        names_by_offset: typing.Dict[int, typing.List[str]],
+) -> typing.Optional[Entry]:
+    # What the run of the slot starting at `now` does for the user, None when there is nothing to do
+    entry: Entry = {}
+    if any(len(names) > 0 for names in names_by_offset.values()):
+        entry["day"] = scheduling.local_date(now, user.timezone).isoformat()
+        if len(names_by_offset.get(0, [])) > 0:
+            entry["names"] = names_by_offset[0]
+        ahead = {str(offset): names for offset, names in sorted(names_by_offset.items()) if offset > 0 and names}
+        if len(ahead) > 0:
+            entry["ahead"] = ahead
+    slot = scheduling.following_reminder_slot(user.timezone, user.local_hour(), now)
+    if slot != user.reminder_hour:
+        entry["slot"] = slot
+    return entry if len(entry) > 0 else None
+
+
+def load_names(
+        days: typing.Iterable[datetime.date],
+        names_by_day: typing.Dict[datetime.date, typing.Dict[str, typing.List[str]]],
+):
+    # Adds the names of the birthdays of the days not in names_by_day yet, by chat, in one lookup
+    missing = [day for day in set(days) if day not in names_by_day]
+    if len(missing) == 0:
+        return
+    for day in missing:
+        names_by_day[day] = {}
+    for day, chat_id, birthday in services.birthday_storage().load_birthdays_by_days(missing):
+        names_by_day[day].setdefault(chat_id, []).append(birthday.name)
+
+
+def plan_slot(
+        users: typing.Iterable[User],
+        now: datetime.datetime,
+        # Date -> names by chat, shared by the slots of a day: they span three local dates (and their
+        # offsets) at most
+        names_by_day: typing.Dict[datetime.date, typing.Dict[str, typing.List[str]]],
+) -> typing.Dict[str, Entry]:
+    users = list(users)
+    local_dates = {user.chat_id: scheduling.local_date(now, user.timezone) for user in users}
+    days = {
+        local_dates[user.chat_id] + datetime.timedelta(days=offset)
+        for user in users
+        for offset in user.reminder_offsets
+    }
+    load_names(days, names_by_day)
+    plan: typing.Dict[str, Entry] = {}
+    for user in users:
+        day = local_dates[user.chat_id]
+        names_by_offset = {
+            offset: names_by_day[day + datetime.timedelta(days=offset)].get(user.chat_id, [])
+            for offset in user.reminder_offsets
+        }
+        entry = plan_entry(user, now, names_by_offset)
+        if entry is not None:
+            plan[user.chat_id] = entry
+    return plan
+
+
+def plan_day(day: datetime.date) -> int:
+    # Plans the 24 slots of the UTC date `day` and returns the number of reminders planned
+    names_by_day: typing.Dict[datetime.date, typing.Dict[str, typing.List[str]]] = {}
+    planned = 0
+    for hour in range(24):
+        users = services.user_storage().load_users_by_reminder_hour(hour)
+        plan = plan_slot(users, slot_start(day, hour), names_by_day)
+        try:
+            services.reminder_state_storage().store_plan(day, hour, plan)
+        except Exception as e:
+            logger.error("Could not store the plan of slot {} {}, it will fall back: {}".format(day, hour, e))
+            continue
+        planned += sum(1 for entry in plan.values() if "day" in entry)
+    logger.info("Planned {} reminders for {}".format(planned, day))
+    return planned
+
+
+def affects_plan(birthday: Birthday, now: datetime.datetime, reminder_offsets: typing.Iterable[int]) -> bool:
+    # Whether the birthday can be in the planned slots of today or tomorrow (UTC), whose local dates go
+    # from yesterday to the day after tomorrow, for one of the offsets
+    today = now.date()
+    return any(
+        (birthday.month, birthday.day) in utils.birthday_days(today + datetime.timedelta(days=day + offset))
+        for offset in reminder_offsets
+        for day in range(-1, 3)
+    )
+
+
+def birthday_changed(chat_id: str, birthday: Birthday, previous: typing.Optional[Birthday] = None):
+    # Patches the plan after the birthday was stored, replacing `previous`, or deleted
+    birthdays = [birthday] if previous is None else [birthday, previous]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Most birthdays are out of reach of any offset, their users are not read
+    widest = range(MAX_REMINDER_DAYS + 1)
+    birthdays = [b for b in birthdays if affects_plan(b, now, widest)]
+    if len(birthdays) == 0:
+        return
+    user = services.user_storage().get_user(chat_id)
+    if user is not None and any(affects_plan(b, now, user.reminder_offsets) for b in birthdays):
+        replan_chat(chat_id, user=user, now=now)
+
+
+def replan_chat(
+        chat_id: str,
+        user: typing.Optional[User] = None,
+        previous_hour: typing.Optional[int] = None,
+        now: typing.Optional[datetime.datetime] = None,
+):
+    # Patches the planned slots of today and tomorrow that are still to run, after the chat's birthdays or
+    # reminder settings (previously in slot previous_hour) changed
+    if user is None:
+        user = services.user_storage().get_user(chat_id)
+        if user is None:
+            return
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    reminder_state_storage = services.reminder_state_storage()
+    for day in (now.date(), now.date() + datetime.timedelta(days=1)):
+        if previous_hour is not None and previous_hour != user.reminder_hour and not has_run(day, previous_hour, now):
+            reminder_state_storage.patch_plan(day, previous_hour, chat_id, None)
+        if has_run(day, user.reminder_hour, now):
+            continue
+        start = slot_start(day, user.reminder_hour)
+        local_day = scheduling.local_date(start, user.timezone)
+        # A single upcoming range covers every offset
+        birthdays = services.birthday_storage().load_upcoming(chat_id, local_day, max(user.reminder_offsets) + 1)
+        names_by_offset = {}
+        for offset in user.reminder_offsets:
+            days = utils.birthday_days(local_day + datetime.timedelta(days=offset))
+            names_by_offset[offset] = [
+                birthday.name for birthday in birthdays if (birthday.month, birthday.day) in days
+            ]
+        reminder_state_storage.patch_plan(day, user.reminder_hour, chat_id, plan_entry(user, start, names_by_offset))
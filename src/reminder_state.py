@@ -0,0 +1,324 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+from src import dynamodb_client, redis_client, utils
+
+if typing.TYPE_CHECKING:
+    import redis
+
+logger = logging.getLogger("root")
+logging.getLogger().setLevel(logging.INFO)
+
+# A claim keeps other runs from delivering the same reminder while it is being sent. It expires so that a
+# run that crashed mid-delivery does not lose the reminder: the next run takes the claim over.
+CLAIM_LEASE_SECONDS = int(os.getenv('REMINDER_CLAIM_LEASE_SECONDS', '900'))
+# Delivered markers and checkpoints only need to outlive the reruns of their day
+STATE_TTL_SECONDS = 3 * 24 * 60 * 60
+
+# A plan maps the chats a reminder slot (UTC date and hour) has to handle to their entry, see
+# src/reminder_plan.py. Storages keep each entry as JSON and one item per slot.
+Plan = typing.Dict[str, dict]
+
+
+class ReminderStateStorage:
+    name: str
+
+    def claim_delivery(self, chat_id: str, day: datetime.date) -> bool:
+        # True when the caller may send the reminder of `day` to the chat
+        pass
+
+    def confirm_delivery(self, chat_id: str, day: datetime.date):
+        pass
+
+    def release_delivery(self, chat_id: str, day: datetime.date):
+        pass
+
+    def load_checkpoint(self, run_id: str, shard: int) -> typing.Optional[dict]:
+        pass
+
+    def store_checkpoint(self, run_id: str, shard: int, checkpoint: dict):
+        pass
+
+    def load_plan(self, day: datetime.date, hour: int) -> typing.Optional[Plan]:
+        # None when the slot was not planned, which is not the same as a plan without chats
+        pass
+
+    def store_plan(self, day: datetime.date, hour: int, plan: Plan):
+        pass
+
+    def patch_plan(self, day: datetime.date, hour: int, chat_id: str, entry: typing.Optional[dict]):
+        # Replaces (or removes, when entry is None) the chat's entry. Slots that were not planned stay so.
+        pass
+
+
+class MemoryReminderStateStorage(ReminderStateStorage):
+    # (chat_id, day) -> (status, lease expiry)
+    deliveries: typing.Dict[typing.Tuple[str, datetime.date], typing.Tuple[str, float]]
+    checkpoints: typing.Dict[typing.Tuple[str, int], dict]
+    plans: typing.Dict[typing.Tuple[datetime.date, int], Plan]
+
+    def __init__(self):
+        self.deliveries = {}
+        self.checkpoints = {}
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    def claim_delivery(self, chat_id: str, day: datetime.date) -> bool:
+        with self.lock:
+            status, lease_until = self.deliveries.get((chat_id, day), (None, 0))
+            if status == "delivered" or (status == "claimed" and lease_until > time.time()):
+                return False
+            self.deliveries[(chat_id, day)] = ("claimed", time.time() + CLAIM_LEASE_SECONDS)
+            return True
+
+    def confirm_delivery(self, chat_id: str, day: datetime.date):
+        with self.lock:
+            self.deliveries[(chat_id, day)] = ("delivered", 0)
+
+    def release_delivery(self, chat_id: str, day: datetime.date):
+        with self.lock:
+            if self.deliveries.get((chat_id, day), ("", 0))[0] == "claimed":
+                del self.deliveries[(chat_id, day)]
+
+    def load_checkpoint(self, run_id: str, shard: int) -> typing.Optional[dict]:
+        return self.checkpoints.get((run_id, shard))
+
+    def store_checkpoint(self, run_id: str, shard: int, checkpoint: dict):
+        self.checkpoints[(run_id, shard)] = dict(checkpoint)
+
+    def load_plan(self, day: datetime.date, hour: int) -> typing.Optional[Plan]:
+        with self.lock:
+            plan = self.plans.get((day, hour))
+            return dict(plan) if plan is not None else None
+
+    def store_plan(self, day: datetime.date, hour: int, plan: Plan):
+        with self.lock:
+            self.plans[(day, hour)] = dict(plan)
+
+    def patch_plan(self, day: datetime.date, hour: int, chat_id: str, entry: typing.Optional[dict]):
+        with self.lock:
+            plan = self.plans.get((day, hour))
+            if plan is None:
+                return
+            if entry is None:
+                plan.pop(chat_id, None)
+            else:
+                plan[chat_id] = entry
+
+
+class RedisReminderStateStorage(ReminderStateStorage):
+    # reminder:{chat_id}:{yyyy-mm-dd} -> "claimed" (expires with the lease) or "delivered"
+    # checkpoint:{run_id}:{shard}     -> JSON checkpoint
+    # plan:{yyyy-mm-dd}:{hour}        -> hash of chat_id -> JSON entry, plus PLAN_MARKER so that a plan
+    #                                    without chats still exists
+
+    PLAN_MARKER = "_"
+
+    # Only patches plans that exist, keeping the slots that were not planned on the fallback
+    PATCH_PLAN_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    if ARGV[2] == '' then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    else
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    end
+    return 1
+    """
+
+    def __init__(self, client: "redis.Redis"):
+        self.redis = client
+        self.patch_plan_script = self.redis.register_script(self.PATCH_PLAN_SCRIPT)
+
+    @staticmethod
+    def _delivery_key(chat_id: str, day: datetime.date) -> str:
+        return f"reminder:{chat_id}:{day.isoformat()}"
+
+    @staticmethod
+    def _checkpoint_key(run_id: str, shard: int) -> str:
+        return f"checkpoint:{run_id}:{shard}"
+
+    @staticmethod
+    def _plan_key(day: datetime.date, hour: int) -> str:
+        return f"plan:{day.isoformat()}:{hour}"
+
+    def claim_delivery(self, chat_id: str, day: datetime.date) -> bool:
+        return bool(self.redis.set(self._delivery_key(chat_id, day), "claimed", nx=True, ex=CLAIM_LEASE_SECONDS))
+
+    def confirm_delivery(self, chat_id: str, day: datetime.date):
+        self.redis.set(self._delivery_key(chat_id, day), "delivered", ex=STATE_TTL_SECONDS)
+
+    def release_delivery(self, chat_id: str, day: datetime.date):
+        self.redis.delete(self._delivery_key(chat_id, day))
+
+    def load_checkpoint(self, run_id: str, shard: int) -> typing.Optional[dict]:
+        checkpoint = self.redis.get(self._checkpoint_key(run_id, shard))
+        return json.loads(checkpoint) if checkpoint is not None else None
+
+    def store_checkpoint(self, run_id: str, shard: int, checkpoint: dict):
+        self.redis.set(self._checkpoint_key(run_id, shard), json.dumps(checkpoint), ex=STATE_TTL_SECONDS)
+
+    def load_plan(self, day: datetime.date, hour: int) -> typing.Optional[Plan]:
+        fields = self.redis.hgetall(self._plan_key(day, hour))
+        if len(fields) == 0:
+            return None
+        return {
+            chat_id.decode("utf-8"): json.loads(entry)
+            for chat_id, entry in fields.items() if chat_id.decode("utf-8") != self.PLAN_MARKER
+        }
+
+    def store_plan(self, day: datetime.date, hour: int, plan: Plan):
+        key = self._plan_key(day, hour)
+        mapping = {chat_id: json.dumps(entry) for chat_id, entry in plan.items()}
+        mapping[self.PLAN_MARKER] = ""
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.delete(key)
+        pipeline.hset(key, mapping=mapping)
+        pipeline.expire(key, STATE_TTL_SECONDS)
+        pipeline.execute()
+
+    def patch_plan(self, day: datetime.date, hour: int, chat_id: str, entry: typing.Optional[dict]):
+        self.patch_plan_script(
+            keys=[self._plan_key(day, hour)],
+            args=[chat_id, json.dumps(entry) if entry is not None else ""],
+        )
+
+
+class DynamoDBReminderStateStorage(ReminderStateStorage):
+    # Items are keyed by id: delivery#{chat_id}#{yyyy-mm-dd}, checkpoint#{run_id}#{shard} or
+    # plan#{yyyy-mm-dd}#{hour}, whose chats map holds the JSON entry of each chat.
+    # expires_at is the table's TTL attribute.
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self.dynamodb_client = dynamodb_client.get_client()
+
+    @staticmethod
+    def _delivery_id(chat_id: str, day: datetime.date) -> str:
+        return f"delivery#{chat_id}#{day.isoformat()}"
+
+    @staticmethod
+    def _checkpoint_id(run_id: str, shard: int) -> str:
+        return f"checkpoint#{run_id}#{shard}"
+
+    @staticmethod
+    def _plan_id(day: datetime.date, hour: int) -> str:
+        return f"plan#{day.isoformat()}#{hour}"
+
+    def claim_delivery(self, chat_id: str, day: datetime.date) -> bool:
+        now = int(time.time())
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item=utils.python_obj_to_dynamo_obj({
+                    'id': self._delivery_id(chat_id, day),
+                    'status': 'claimed',
+                    'lease_until': now + CLAIM_LEASE_SECONDS,
+                    'expires_at': now + STATE_TTL_SECONDS,
+                }),
+                ConditionExpression='attribute_not_exists(id) OR (#status = :claimed AND lease_until < :now)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({':claimed': 'claimed', ':now': now}),
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def confirm_delivery(self, chat_id: str, day: datetime.date):
+        self.dynamodb_client.update_item(
+            TableName=self.table_name,
+            Key=utils.python_obj_to_dynamo_obj({'id': self._delivery_id(chat_id, day)}),
+            UpdateExpression='SET #status = :delivered',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({':delivered': 'delivered'}),
+        )
+
+    def release_delivery(self, chat_id: str, day: datetime.date):
+        try:
+            self.dynamodb_client.delete_item(
+                TableName=self.table_name,
+                Key=utils.python_obj_to_dynamo_obj({'id': self._delivery_id(chat_id, day)}),
+                ConditionExpression='#status = :claimed',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({':claimed': 'claimed'}),
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def load_checkpoint(self, run_id: str, shard: int) -> typing.Optional[dict]:
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key=utils.python_obj_to_dynamo_obj({'id': self._checkpoint_id(run_id, shard)}),
+            ConsistentRead=True,
+        )
+        if 'Item' not in response:
+            return None
+        return json.loads(utils.dynamo_obj_to_python_obj(response['Item'])['checkpoint'])
+
+    def store_checkpoint(self, run_id: str, shard: int, checkpoint: dict):
+        self.dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item=utils.python_obj_to_dynamo_obj({
+                'id': self._checkpoint_id(run_id, shard),
+                'checkpoint': json.dumps(checkpoint),
+                'expires_at': int(time.time()) + STATE_TTL_SECONDS,
+            }),
+        )
+
+    def load_plan(self, day: datetime.date, hour: int) -> typing.Optional[Plan]:
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'id': {'S': self._plan_id(day, hour)}},
+            ConsistentRead=True,
+        )
+        if 'Item' not in response:
+            return None
+        chats = response['Item']['chats']['M']
+        return {chat_id: json.loads(entry['S']) for chat_id, entry in chats.items()}
+
+    def store_plan(self, day: datetime.date, hour: int, plan: Plan):
+        # An item holds up to 400 KB, a slot too large to store is left to the fallback
+        self.dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                'id': {'S': self._plan_id(day, hour)},
+                'chats': {'M': {chat_id: {'S': json.dumps(entry)} for chat_id, entry in plan.items()}},
+                'expires_at': {'N': str(int(time.time()) + STATE_TTL_SECONDS)},
+            },
+        )
+
+    def patch_plan(self, day: datetime.date, hour: int, chat_id: str, entry: typing.Optional[dict]):
+        kwargs = {}
+        if entry is None:
+            update_expression = 'REMOVE chats.#chat_id'
+        else:
+            update_expression = 'SET chats.#chat_id = :entry'
+            kwargs['ExpressionAttributeValues'] = {':entry': {'S': json.dumps(entry)}}
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key={'id': {'S': self._plan_id(day, hour)}},
+                UpdateExpression=update_expression,
+                ConditionExpression='attribute_exists(id)',
+                ExpressionAttributeNames={'#chat_id': chat_id},
+                **kwargs,
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+def build_storage(storage_type: str) -> ReminderStateStorage:
+    if storage_type == "Memory":
+        return MemoryReminderStateStorage()
+    if storage_type == "Redis":
+        return RedisReminderStateStorage(client=redis_client.get_client())
+    if storage_type == "DynamoDB":
+        return DynamoDBReminderStateStorage(table_name=os.getenv('REMINDER_STATE_TABLE_NAME'))
+    else:
+        raise ValueError(f"Unknown storage type: {storage_type}")
@@ -1,44 +1,134 @@
+import dataclasses
 import datetime
 import sys
 import os
 import logging
-import math
+import typing
+import zlib
+
+from concurrent import futures
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
-from src.birthday_storage import build_storage as build_birthday_storage
-from src.user_storage import build_storage as build_user_storage
-from src.bot import bot
+from src.delivery import Delivery, DeliverySummary
+from src import metrics, reminder_plan, services
 
 logger = logging.getLogger("root")
 logging.getLogger().setLevel(logging.INFO)
 
-STORAGE_TYPE = os.getenv('STORAGE_TYPE')
-birthday_storage = build_birthday_storage(STORAGE_TYPE)
-user_storage = build_user_storage(STORAGE_TYPE)
+REMINDER_SHARDS = int(os.getenv('REMINDER_SHARDS', '1'))
+
+
+def load_plan(now: datetime.datetime) -> typing.Dict[str, reminder_plan.Entry]:
+    # The slot's planned entries, or the join of its users and birthdays when it was not planned
+    plan = services.reminder_state_storage().load_plan(now.date(), now.hour)
+    if plan is not None:
+        return plan
+    logger.info("Slot {} was not planned, joining its users and birthdays".format(run_id(now)))
+    return reminder_plan.plan_slot(services.user_storage().load_users_by_reminder_hour(now.hour), now, {})
+
+
+def reschedule(plan: typing.Dict[str, reminder_plan.Entry]):
+    # Moves users whose UTC offset changes before their next reminder (DST) to their new slot
+    for chat_id, entry in plan.items():
+        if "slot" in entry:
+            services.user_storage().update_reminder_hour(chat_id, entry["slot"])
+
+
+def reminder_text(entry: reminder_plan.Entry) -> str:
+    lines = []
+    names = entry.get("names", [])
+    if len(names) == 1:
+        lines.append("Its {} birthday today!".format(names[0]))
+    elif len(names) > 1:
+        lines.append("Today's birthdays: {}".format(", ".join(names)))
+    for days, names in sorted(entry.get("ahead", {}).items(), key=lambda item: int(item[0])):
+        when = "tomorrow" if int(days) == 1 else "in {} days".format(days)
+        if len(names) == 1:
+            lines.append("{}'s birthday is {}".format(names[0], when))
+        else:
+            lines.append("Birthdays {}: {}".format(when, ", ".join(names)))
+    return "\n".join(lines)
+
+
+def send_reminder(chat_id: str, text: str):
+    services.bot().send_message(chat_id=chat_id, text=text)
+
+
+def shard_of(chat_id: str, shards: int) -> int:
+    return zlib.crc32(chat_id.encode("utf-8")) % shards
+
+
+def run_id(now: datetime.datetime) -> str:
+    # Identifies the hourly run, reruns within the same hour resume its checkpoints
+    return now.strftime("%Y-%m-%dT%H")
+
+
+@metrics.command("reminder")
+def remind_shard(now: datetime.datetime, shard: int, shards: int) -> DeliverySummary:
+    reminder_state_storage = services.reminder_state_storage()
+    checkpoint = reminder_state_storage.load_checkpoint(run_id(now), shard)
+    if checkpoint is not None and checkpoint["done"]:
+        logger.info("Shard {}/{} of run {} already done".format(shard, shards, run_id(now)))
+        return DeliverySummary(**checkpoint["summary"])
+    reminder_state_storage.store_checkpoint(run_id(now), shard, {"done": False})
+
+    plan = {chat_id: entry for chat_id, entry in load_plan(now).items() if shard_of(chat_id, shards) == shard}
+    days = {chat_id: datetime.date.fromisoformat(entry["day"]) for chat_id, entry in plan.items() if "day" in entry}
+
+    def deliver(chat_id: str, text: str) -> bool:
+        # Delivered markers make reruns skip the chats a previous attempt already reached.
+        # Delivery threads don't inherit the command context, it is set again for their metrics.
+        with metrics.command_context("reminder"):
+            if not reminder_state_storage.claim_delivery(chat_id, days[chat_id]):
+                return False
+            try:
+                send_reminder(chat_id, text)
+            except Exception:
+                reminder_state_storage.release_delivery(chat_id, days[chat_id])
+                raise
+            reminder_state_storage.confirm_delivery(chat_id, days[chat_id])
+            return True
+
+    messages = [(chat_id, reminder_text(entry)) for chat_id, entry in plan.items() if chat_id in days]
+    summary = Delivery(deliver).deliver(messages)
+    reschedule(plan)
+    reminder_state_storage.store_checkpoint(
+        run_id(now), shard, {"done": True, "summary": dataclasses.asdict(summary)}
+    )
+    logger.info("Reminders delivered by shard {}/{}: {}".format(shard, shards, summary))
+    return summary
+
+
+def reminder(now: typing.Optional[datetime.datetime] = None, shards: int = REMINDER_SHARDS) -> DeliverySummary:
+    # Shards run in their own processes, which don't see the data of the Memory storage
+    if shards > 1 and services.STORAGE_TYPE == "Memory":
+        raise ValueError("The Memory storage can't be sharded, set REMINDER_SHARDS to 1")
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    if shards <= 1:
+        return remind_shard(now, 0, 1)
 
+    summary = DeliverySummary()
+    with futures.ProcessPoolExecutor(max_workers=shards) as executor:
+        for shard_summary in executor.map(remind_shard, [now] * shards, range(shards), [shards] * shards):
+            summary.add(shard_summary)
+    logger.info("Reminders delivered: {}".format(summary))
+    return summary
 
-def reminder():
-    now = datetime.datetime.now()
-    today = now.date()
 
-    users_to_remind = user_storage.load_users_by_reminder_hour(now.hour)
-    chat_ids_to_remind = [user.chat_id for user in users_to_remind]
-    birthdays_with_chat_id = birthday_storage.load_birthdays_by_day(today)
-    for chat_id, birthday in birthdays_with_chat_id:
-        if chat_id not in chat_ids_to_remind:
-            continue
-        text = "Its {} birthday today!".format(birthday.name)
-        try:
-            bot.send_message(chat_id=chat_id, text=text)
-        except Exception as e:
-            text = 'An error occurred while processing your request: {}'.format(str(e))
-            bot.send_message(chat_id=chat_id, text=text)
-            logger.error(text.format(e))
-    return {'statusCode': 200}
+def plan(day: typing.Optional[datetime.date] = None) -> int:
+    # Plans the slots of `day`, tomorrow (UTC) by default: the planner runs shortly before midnight
+    if day is None:
+        day = datetime.datetime.now(datetime.timezone.utc).date() + datetime.timedelta(days=1)
+    with metrics.command_context("plan"):
+        return reminder_plan.plan_day(day)
 
 
 if __name__ == '__main__':
-    reminder()
+    if len(sys.argv) > 1 and sys.argv[1] == 'plan':
+        plan(datetime.date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else None)
+    else:
+        reminder()
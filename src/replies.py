@@ -0,0 +1,59 @@
+import contextlib
+import threading
+import typing
+
+from src.bot import bot
+
+# Telegram lets a webhook answer an update with one Bot API call in the response body, which saves the
+# outbound request handlers would otherwise make. Entry points that can do so collect the handlers' replies.
+_local = threading.local()
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+@contextlib.contextmanager
+def collect() -> typing.Iterator[typing.List[dict]]:
+    replies: typing.List[dict] = []
+    _local.replies = replies
+    try:
+        yield replies
+    finally:
+        _local.replies = None
+
+
+def send_message(chat_id: typing.Union[int, str], text: str, **kwargs):
+    replies = getattr(_local, 'replies', None)
+    if replies is None:
+        bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    else:
+        replies.append(dict(chat_id=chat_id, text=text, **kwargs))
+
+
+def split_lines(lines: typing.Iterable[str], limit: int = MAX_MESSAGE_LENGTH) -> typing.List[str]:
+    # Joins lines into as few messages as fit Telegram's length limit, lines longer than the limit are cut
+    messages: typing.List[str] = []
+    chunk: typing.List[str] = []
+    size = 0
+    for line in lines:
+        line = line[:limit]
+        if len(chunk) > 0 and size + 1 + len(line) > limit:
+            messages.append("\n".join(chunk))
+            chunk, size = [], 0
+        size += len(line) + (1 if len(chunk) > 0 else 0)
+        chunk.append(line)
+    if len(chunk) > 0:
+        messages.append("\n".join(chunk))
+    return messages
+
+
+def webhook_response(replies: typing.List[dict]) -> typing.Optional[dict]:
+    # A single reply becomes the response body; several are sent in order through the Bot API instead,
+    # since the response body would only be delivered after all of them
+    if len(replies) == 1:
+        reply = dict(replies[0])
+        if reply.get('reply_markup') is not None:
+            reply['reply_markup'] = reply['reply_markup'].to_dict()
+        return {'method': 'sendMessage', **reply}
+    for reply in replies:
+        bot.send_message(**reply)
+    return None
@@ -0,0 +1,46 @@
+import datetime
+import zoneinfo
+
+# Users keep an IANA timezone and a local reminder hour. The storages index them by reminder_hour, the UTC
+# hour ("slot") of their next reminder, so an hourly run only looks up the users of the current slot.
+# Slots move when the UTC offset changes (DST), and are re-evaluated each time a user's reminder fires.
+
+DEFAULT_TIMEZONE = "UTC"
+
+
+def is_valid_timezone(timezone: str) -> bool:
+    try:
+        zoneinfo.ZoneInfo(timezone)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+def local_date(now: datetime.datetime, timezone: str) -> datetime.date:
+    return now.astimezone(zoneinfo.ZoneInfo(timezone)).date()
+
+
+def reminder_time(timezone: str, local_hour: int, day: datetime.date) -> datetime.datetime:
+    # UTC start of the slot that reminds of the local date `day` at local_hour. Offsets that are not whole
+    # hours fire at the start of the following UTC hour, up to 59 minutes late: firing early would fall on
+    # the previous local date for local hour 0.
+    local = datetime.datetime.combine(day, datetime.time(local_hour), tzinfo=zoneinfo.ZoneInfo(timezone))
+    utc = local.astimezone(datetime.timezone.utc)
+    slot = utc.replace(minute=0, second=0, microsecond=0)
+    return slot if slot == utc else slot + datetime.timedelta(hours=1)
+
+
+def reminder_slot(timezone: str, local_hour: int, day: datetime.date) -> int:
+    return reminder_time(timezone, local_hour, day).hour
+
+
+def next_reminder_slot(timezone: str, local_hour: int, now: datetime.datetime) -> int:
+    day = local_date(now, timezone)
+    if reminder_time(timezone, local_hour, day) <= now:
+        day += datetime.timedelta(days=1)
+    return reminder_slot(timezone, local_hour, day)
+
+
+def following_reminder_slot(timezone: str, local_hour: int, now: datetime.datetime) -> int:
+    # Slot for the day after the reminder firing at `now`, called from the reminder run
+    return reminder_slot(timezone, local_hour, local_date(now, timezone) + datetime.timedelta(days=1))
@@ -0,0 +1,39 @@
+import functools
+import os
+import typing
+
+from src import metrics
+
+if typing.TYPE_CHECKING:
+    import telebot
+    from src.birthday_storage import BirthdayStorage
+    from src.reminder_state import ReminderStateStorage
+    from src.user_storage import UserStorage
+
+# Shared, lazily built services. Entry points import only what their path needs and each object is built
+# on first use, once per process, so cold starts skip the backends (and their imports) that are not used.
+
+STORAGE_TYPE = os.getenv('STORAGE_TYPE')
+
+
+@functools.lru_cache(maxsize=None)
+def birthday_storage() -> "BirthdayStorage":
+    from src.birthday_storage import build_storage
+    return metrics.InstrumentedStorage(build_storage(STORAGE_TYPE), "birthday")
+
+
+@functools.lru_cache(maxsize=None)
+def user_storage() -> "UserStorage":
+    from src.user_storage import build_storage
+    return metrics.InstrumentedStorage(build_storage(STORAGE_TYPE), "user")
+
+
+@functools.lru_cache(maxsize=None)
+def reminder_state_storage() -> "ReminderStateStorage":
+    from src.reminder_state import build_storage
+    return metrics.InstrumentedStorage(build_storage(STORAGE_TYPE), "reminder_state")
+
+
+def bot() -> "telebot.TeleBot":
+    from src.bot import bot
+    return bot
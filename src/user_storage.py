@@ -1,37 +1,72 @@
 import dataclasses
 import typing
-import boto3
 import logging
 import os
 
-from botocore import config as botocore_config
-from src import utils
+from src import dynamo_codec, dynamodb_client, redis_client, scheduling, utils
 
+if typing.TYPE_CHECKING:
+    import redis
 
 logger = logging.getLogger("root")
 logging.getLogger().setLevel(logging.INFO)
 
+# Reminding on the birthday itself only
+DEFAULT_REMINDER_OFFSETS = [0]
 
-@dataclasses.dataclass
+
+@dataclasses.dataclass(slots=True)
 class User:
     chat_id: str
     user_name: str
     first_name: str
     last_name: str
+    # UTC hour of the next reminder, the indexed slot (see src/scheduling.py)
     reminder_hour: int
+    timezone: str = scheduling.DEFAULT_TIMEZONE
+    # Hour chosen by the user in their timezone, None for users that only ever set a UTC hour
+    local_reminder_hour: typing.Optional[int] = None
+    # Days before each birthday to remind of it, 0 being the day itself
+    reminder_offsets: typing.List[int] = dataclasses.field(default_factory=lambda: list(DEFAULT_REMINDER_OFFSETS))
 
-    def __init__(self, chat_id: str, user_name: str, first_name: str, last_name: str, reminder_hour: int):
+    def __init__(
+            self,
+            chat_id: str,
+            user_name: str,
+            first_name: str,
+            last_name: str,
+            reminder_hour: int,
+            timezone: str = scheduling.DEFAULT_TIMEZONE,
+            local_reminder_hour: typing.Optional[int] = None,
+            reminder_offsets: typing.Optional[typing.List[int]] = None,
+    ):
         self.chat_id = chat_id
         self.user_name = user_name
         self.first_name = first_name
         self.last_name = last_name
         self.reminder_hour = reminder_hour
+        self.timezone = timezone
+        self.local_reminder_hour = local_reminder_hour
+        self.reminder_offsets = list(reminder_offsets) if reminder_offsets else list(DEFAULT_REMINDER_OFFSETS)
+
+    def local_hour(self) -> int:
+        return self.local_reminder_hour if self.local_reminder_hour is not None else self.reminder_hour
+
+
+@dataclasses.dataclass
+class QueryStats:
+    pages: int = 0
+    items: int = 0
+    consumed_capacity: float = 0.0
 
 
 class UserStorage:
     name: str
 
-    def load_users_by_reminder_hour(self, reminder_hour: int) -> typing.List[User]:
+    def load_users_by_reminder_hour(self, reminder_hour: int) -> typing.Iterable[User]:
+        pass
+
+    def get_user(self, chat_id: str) -> typing.Optional[User]:
         pass
 
     def store_user(self, user: User):
@@ -40,64 +75,248 @@ class UserStorage:
     def update_reminder_hour(self, chat_id: str, reminder_hour: int):
         pass
 
+    def update_reminder_schedule(self, chat_id: str, reminder_hour: int, timezone: str, local_reminder_hour: int):
+        pass
+
+    def update_reminder_offsets(self, chat_id: str, reminder_offsets: typing.List[int]):
+        pass
+
 
 class MemoryUserStorage(UserStorage):
-    users: typing.List[User] = []
+    users: typing.Dict[str, User]
+    # reminder_hour -> chat_ids
+    hours: typing.Dict[int, typing.Set[str]]
+
+    def __init__(self):
+        self.users = {}
+        self.hours = {}
 
     def load_users_by_reminder_hour(self, reminder_hour: int) -> typing.List[User]:
-        return [user for user in self.users if user.reminder_hour == reminder_hour]
+        return [self.users[chat_id] for chat_id in self.hours.get(reminder_hour, ())]
+
+    def get_user(self, chat_id: str) -> typing.Optional[User]:
+        return self.users.get(chat_id)
 
     def store_user(self, user: User):
-        self.users.append(user)
+        previous = self.users.get(user.chat_id)
+        if previous is not None:
+            self._unindex(previous)
+        self.users[user.chat_id] = user
+        self.hours.setdefault(user.reminder_hour, set()).add(user.chat_id)
 
     def update_reminder_hour(self, chat_id: str, reminder_hour: int):
-        user = next((user for user in self.users if user.chat_id == chat_id), None)
+        user = self.users.get(chat_id)
         if user:
+            self._unindex(user)
             user.reminder_hour = reminder_hour
+            self.hours.setdefault(reminder_hour, set()).add(chat_id)
+
+    def update_reminder_schedule(self, chat_id: str, reminder_hour: int, timezone: str, local_reminder_hour: int):
+        user = self.users.get(chat_id)
+        if user:
+            self.update_reminder_hour(chat_id, reminder_hour)
+            user.timezone = timezone
+            user.local_reminder_hour = local_reminder_hour
+
+    def update_reminder_offsets(self, chat_id: str, reminder_offsets: typing.List[int]):
+        user = self.users.get(chat_id)
+        if user:
+            user.reminder_offsets = list(reminder_offsets)
+
+    def _unindex(self, user: User):
+        chat_ids = self.hours[user.reminder_hour]
+        chat_ids.discard(user.chat_id)
+        if len(chat_ids) == 0:
+            del self.hours[user.reminder_hour]
+
+
+class RedisUserStorage(UserStorage):
+    # Data model:
+    #   user:{chat_id}     -> hash of the user's attributes, None attributes are left out
+    #   users:hour:{hour}  -> set of chat_ids whose reminder_hour is hour, the index used by the reminder
+    # Both are kept in sync by Lua scripts, so moving a user between hours is atomic.
+
+    # KEYS[1] is the user hash, KEYS[2] the new hour set and KEYS[3..26] the sets of hours 0 to 23, so that
+    # the previous hour's set is passed in too. ARGV holds chat_id, reminder_hour and then the other field,
+    # value pairs.
+    STORE_SCRIPT = """
+        local old = redis.call('HGET', KEYS[1], 'reminder_hour')
+        if old then
+            redis.call('SREM', KEYS[3 + tonumber(old)], ARGV[1])
+        end
+        redis.call('DEL', KEYS[1])
+        redis.call('HSET', KEYS[1], 'reminder_hour', ARGV[2], unpack(ARGV, 3))
+        redis.call('SADD', KEYS[2], ARGV[1])
+    """
+
+    # Same keys and arguments as STORE_SCRIPT, but only updates users that exist and keeps the fields not given
+    UPDATE_SCRIPT = """
+        local old = redis.call('HGET', KEYS[1], 'reminder_hour')
+        if not old then
+            return 0
+        end
+        redis.call('SREM', KEYS[3 + tonumber(old)], ARGV[1])
+        redis.call('HSET', KEYS[1], 'reminder_hour', ARGV[2], unpack(ARGV, 3))
+        redis.call('SADD', KEYS[2], ARGV[1])
+        return 1
+    """
+
+    # Sets ARGV's field, value pairs on users that exist
+    SET_FIELDS_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        redis.call('HSET', KEYS[1], unpack(ARGV))
+        return 1
+    """
+
+    # Fields read by the reminder, the names are left as None like in DynamoDBUserStorage
+    REMINDER_FIELDS = ['reminder_hour', 'timezone', 'local_reminder_hour', 'reminder_offsets']
+    BATCH_SIZE = 500
+
+    def __init__(self, client: "redis.Redis"):
+        self.redis = client
+        self.store_script = self.redis.register_script(self.STORE_SCRIPT)
+        self.update_script = self.redis.register_script(self.UPDATE_SCRIPT)
+        self.set_fields_script = self.redis.register_script(self.SET_FIELDS_SCRIPT)
+
+    @staticmethod
+    def _user_key(chat_id: str) -> str:
+        return f"user:{chat_id}"
+
+    @staticmethod
+    def _hour_key(reminder_hour: int) -> str:
+        return f"users:hour:{reminder_hour}"
+
+    def _schedule_keys(self, chat_id: str, reminder_hour: int) -> typing.List[str]:
+        return [self._user_key(chat_id), self._hour_key(reminder_hour)] + [self._hour_key(hour) for hour in range(24)]
+
+    @staticmethod
+    def _user(chat_id: str, fields: typing.Dict[str, typing.Optional[str]]) -> User:
+        return User(
+            chat_id=chat_id,
+            user_name=fields.get('user_name'),
+            first_name=fields.get('first_name'),
+            last_name=fields.get('last_name'),
+            reminder_hour=int(fields['reminder_hour']),
+            timezone=fields.get('timezone') or scheduling.DEFAULT_TIMEZONE,
+            local_reminder_hour=int(fields['local_reminder_hour']) if fields.get('local_reminder_hour') else None,
+            # Comma separated, e.g. "7,1,0"
+            reminder_offsets=[int(offset) for offset in fields['reminder_offsets'].split(",")]
+            if fields.get('reminder_offsets') else None,
+        )
+
+    def load_users_by_reminder_hour(self, reminder_hour: int) -> typing.Iterator[User]:
+        # The hour set is scanned in batches and each batch is read with one pipelined round trip of HMGETs
+        chat_ids: typing.List[str] = []
+        for chat_id in self.redis.sscan_iter(self._hour_key(reminder_hour), count=self.BATCH_SIZE):
+            chat_ids.append(chat_id.decode("utf-8"))
+            if len(chat_ids) == self.BATCH_SIZE:
+                yield from self._load_reminder_users(chat_ids, reminder_hour)
+                chat_ids = []
+        if chat_ids:
+            yield from self._load_reminder_users(chat_ids, reminder_hour)
+
+    def _load_reminder_users(self, chat_ids: typing.List[str], reminder_hour: int) -> typing.Iterator[User]:
+        pipeline = self.redis.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipeline.hmget(self._user_key(chat_id), self.REMINDER_FIELDS)
+        for chat_id, values in zip(chat_ids, pipeline.execute()):
+            if values[0] is None or int(values[0]) != reminder_hour:
+                # The user was deleted, or moved to another hour, after the scan read its chat_id
+                continue
+            fields = {
+                field: value.decode("utf-8") if value is not None else None
+                for field, value in zip(self.REMINDER_FIELDS, values)
+            }
+            yield self._user(chat_id, fields)
+
+    def get_user(self, chat_id: str) -> typing.Optional[User]:
+        fields = self.redis.hgetall(self._user_key(chat_id))
+        if not fields:
+            return None
+        return self._user(chat_id, {field.decode("utf-8"): value.decode("utf-8") for field, value in fields.items()})
+
+    def store_user(self, user: User):
+        fields = {
+            'user_name': user.user_name,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'timezone': user.timezone,
+            'local_reminder_hour': user.local_hour(),
+            'reminder_offsets': ",".join(str(offset) for offset in user.reminder_offsets),
+        }
+        self.store_script(
+            keys=self._schedule_keys(user.chat_id, int(user.reminder_hour)),
+            args=[user.chat_id, int(user.reminder_hour)] + [
+                item for field, value in fields.items() if value is not None for item in (field, value)
+            ],
+        )
+
+    def update_reminder_hour(self, chat_id: str, reminder_hour: int):
+        self.update_script(keys=self._schedule_keys(chat_id, int(reminder_hour)), args=[chat_id, int(reminder_hour)])
+
+    def update_reminder_schedule(self, chat_id: str, reminder_hour: int, timezone: str, local_reminder_hour: int):
+        self.update_script(
+            keys=self._schedule_keys(chat_id, int(reminder_hour)),
+            args=[chat_id, int(reminder_hour), 'timezone', timezone, 'local_reminder_hour', int(local_reminder_hour)],
+        )
+
+    def update_reminder_offsets(self, chat_id: str, reminder_offsets: typing.List[int]):
+        self.set_fields_script(
+            keys=[self._user_key(chat_id)],
+            args=['reminder_offsets', ",".join(str(offset) for offset in reminder_offsets)],
+        )
+
 
 class DynamoDBUserStorage(UserStorage):
     table_name: str = None
-    dynamodb: boto3.resource = None
-    table: boto3.resource = None
 
     def __init__(self, table_name: str):
         self.table_name = table_name
-        dynamodb_config = botocore_config.Config(connect_timeout=2, read_timeout=2)
-        self.dynamodb_client = boto3.client('dynamodb', config=dynamodb_config, region_name='sa-east-1')
+        self.dynamodb_client = dynamodb_client.get_client()
+        self.last_query_stats = QueryStats()
 
-    def load_users_by_reminder_hour(self, reminder_hour: int) -> typing.List[User]:
-        response = self.dynamodb_client.scan(
-            TableName=self.table_name,
-            IndexName='ReminderHourIndex',
-            FilterExpression='reminder_hour = :reminder_hour',
-            ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({
+    def load_users_by_reminder_hour(self, reminder_hour: int) -> typing.Iterator[User]:
+        # Only the attributes the reminder needs are read, the names are left as None
+        stats = QueryStats()
+        self.last_query_stats = stats
+        kwargs = {
+            'TableName': self.table_name,
+            'IndexName': 'ReminderHourIndex',
+            'KeyConditionExpression': 'reminder_hour = :reminder_hour',
+            'ProjectionExpression': 'chat_id, reminder_hour, #timezone, local_reminder_hour, reminder_offsets',
+            'ExpressionAttributeNames': {'#timezone': 'timezone'},
+            'ExpressionAttributeValues': utils.python_obj_to_dynamo_obj({
                 ':reminder_hour': reminder_hour
-            })
+            }),
+            'ReturnConsumedCapacity': 'TOTAL',
+        }
+        while True:
+            response = self.dynamodb_client.query(**kwargs)
+            stats.pages += 1
+            stats.items += response['Count']
+            stats.consumed_capacity += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+            for item in response['Items']:
+                yield dynamo_codec.user_from_item(item)
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        logger.info("Loaded users for reminder hour {}: {}".format(reminder_hour, stats))
+
+    def get_user(self, chat_id: str) -> typing.Optional[User]:
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id})
         )
-        users: typing.List[User] = []
-        for item in response['Items']:
-            item = utils.dynamo_obj_to_python_obj(item)
-            user = User(
-                chat_id=item['chat_id'],
-                user_name=item['user_name'],
-                first_name=item['first_name'],
-                last_name=item['last_name'],
-                reminder_hour=item['reminder_hour']
-            )
-            users.append(user)
-
-        return users
+        if 'Item' not in response:
+            return None
+        return dynamo_codec.user_from_item(response['Item'])
 
     def store_user(self, user: User):
         self.dynamodb_client.put_item(
             TableName=self.table_name,
-            Item=utils.python_obj_to_dynamo_obj({
-                'chat_id': user.chat_id,
-                'user_name': str(user.user_name),
-                'first_name': str(user.first_name),
-                'last_name': str(user.last_name),
-                'reminder_hour': int(user.reminder_hour),
-            }),
+            Item=dynamo_codec.user_to_item(user),
         )
 
     def update_reminder_hour(self, chat_id: str, reminder_hour: int):
@@ -110,10 +329,34 @@ class DynamoDBUserStorage(UserStorage):
             }),
         )
 
+    def update_reminder_schedule(self, chat_id: str, reminder_hour: int, timezone: str, local_reminder_hour: int):
+        self.dynamodb_client.update_item(
+            TableName=self.table_name,
+            Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id}),
+            UpdateExpression='SET reminder_hour = :reminder_hour, #timezone = :timezone, '
+                             'local_reminder_hour = :local_reminder_hour',
+            ExpressionAttributeNames={'#timezone': 'timezone'},
+            ExpressionAttributeValues=utils.python_obj_to_dynamo_obj({
+                ':reminder_hour': int(reminder_hour),
+                ':timezone': timezone,
+                ':local_reminder_hour': int(local_reminder_hour),
+            }),
+        )
+
+    def update_reminder_offsets(self, chat_id: str, reminder_offsets: typing.List[int]):
+        self.dynamodb_client.update_item(
+            TableName=self.table_name,
+            Key=utils.python_obj_to_dynamo_obj({'chat_id': chat_id}),
+            UpdateExpression='SET reminder_offsets = :reminder_offsets',
+            ExpressionAttributeValues={':reminder_offsets': dynamo_codec.offsets_to_attribute(reminder_offsets)},
+        )
+
 
 def build_storage(storage_type: str) -> UserStorage:
     if storage_type == "DynamoDB":
         return DynamoDBUserStorage(table_name=os.getenv('USERS_TABLE_NAME'))
+    elif storage_type == "Redis":
+        return RedisUserStorage(client=redis_client.get_client())
     elif storage_type == "Memory":
         return MemoryUserStorage()
     else:
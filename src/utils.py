@@ -1,8 +1,26 @@
-from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import calendar
+import datetime
+import functools
+import typing
+
+if typing.TYPE_CHECKING:
+    from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+
+@functools.lru_cache(maxsize=None)
+def _deserializer() -> "TypeDeserializer":
+    from boto3.dynamodb.types import TypeDeserializer
+    return TypeDeserializer()
+
+
+@functools.lru_cache(maxsize=None)
+def _serializer() -> "TypeSerializer":
+    from boto3.dynamodb.types import TypeSerializer
+    return TypeSerializer()
 
 
 def dynamo_obj_to_python_obj(dynamo_obj: dict) -> dict:
-    deserializer = TypeDeserializer()
+    deserializer = _deserializer()
     return {
         k: deserializer.deserialize(v)
         for k, v in dynamo_obj.items()
@@ -10,7 +28,7 @@ def dynamo_obj_to_python_obj(dynamo_obj: dict) -> dict:
 
 
 def python_obj_to_dynamo_obj(python_obj: dict) -> dict:
-    serializer = TypeSerializer()
+    serializer = _serializer()
     return {
         k: serializer.serialize(v)
         for k, v in python_obj.items()
@@ -23,4 +41,28 @@ def represents_int(s):
     except ValueError:
         return False
     else:
-        return True
\ No newline at end of file
+        return True
+
+
+def birthday_days(day: datetime.date) -> typing.List[typing.Tuple[int, int]]:
+    # (month, day) pairs celebrated on the given date: Feb 29 birthdays are celebrated on Feb 28 in non-leap years
+    days = [(day.month, day.day)]
+    if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+        days.append((2, 29))
+    return days
+
+
+def mmdd(month: int, day: int) -> int:
+    return month * 100 + day
+
+
+def upcoming_ranges(start: datetime.date, days: int) -> typing.List[typing.Tuple[int, int]]:
+    # Inclusive MMDD ranges covering [start, start + days), in order of occurrence from start
+    if days <= 0:
+        return []
+    end = start + datetime.timedelta(days=days - 1)
+    start_mmdd = mmdd(start.month, start.day)
+    end_mmdd = max(mmdd(month, day) for month, day in birthday_days(end))
+    if end.year == start.year:
+        return [(start_mmdd, end_mmdd)]
+    return [(start_mmdd, mmdd(12, 31)), (mmdd(1, 1), end_mmdd)]
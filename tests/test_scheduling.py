@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+from src import scheduling
+
+UTC = datetime.timezone.utc
+
+
+def utc(*args) -> datetime.datetime:
+    return datetime.datetime(*args, tzinfo=UTC)
+
+
+@pytest.mark.parametrize("timezone, local_hour, day, expected", [
+    ("UTC", 9, datetime.date(2026, 10, 18), utc(2026, 10, 18, 9)),
+    ("America/Montevideo", 9, datetime.date(2026, 10, 18), utc(2026, 10, 18, 12)),
+    ("Asia/Tokyo", 0, datetime.date(2026, 10, 18), utc(2026, 10, 17, 15)),
+    # Offsets that are not whole hours fire at the start of the following UTC hour
+    ("Asia/Kolkata", 9, datetime.date(2026, 10, 18), utc(2026, 10, 18, 4)),
+    ("Asia/Kolkata", 0, datetime.date(2026, 10, 18), utc(2026, 10, 17, 19)),
+    ("Asia/Kolkata", 23, datetime.date(2026, 10, 18), utc(2026, 10, 18, 18)),
+    ("Asia/Kathmandu", 0, datetime.date(2026, 10, 18), utc(2026, 10, 17, 19)),
+    ("America/St_Johns", 0, datetime.date(2026, 1, 10), utc(2026, 1, 10, 4)),
+    ("America/St_Johns", 0, datetime.date(2026, 7, 10), utc(2026, 7, 10, 3)),
+])
+def test_reminder_time(timezone, local_hour, day, expected):
+    assert scheduling.reminder_time(timezone, local_hour, day) == expected
+    assert scheduling.reminder_slot(timezone, local_hour, day) == expected.hour
+
+
+@pytest.mark.parametrize("timezone, day, before, after", [
+    # Daylight saving time starts on March 8th 2026 in New York and ends on October 25th 2026 in London
+    ("America/New_York", datetime.date(2026, 3, 8), 14, 13),
+    ("Europe/London", datetime.date(2026, 10, 25), 8, 9),
+    # Lord Howe moves by half an hour
+    ("Australia/Lord_Howe", datetime.date(2026, 4, 5), 22, 23),
+])
+def test_reminder_slot_across_dst(timezone, day, before, after):
+    assert scheduling.reminder_slot(timezone, 9, day - datetime.timedelta(days=1)) == before
+    assert scheduling.reminder_slot(timezone, 9, day + datetime.timedelta(days=1)) == after
+
+
+@pytest.mark.parametrize("timezone", [
+    "UTC", "America/New_York", "America/St_Johns", "Pacific/Marquesas", "Europe/London", "Asia/Kolkata",
+    "Asia/Kathmandu", "Australia/Adelaide", "Australia/Lord_Howe", "Pacific/Chatham", "Pacific/Kiritimati",
+])
+def test_slot_falls_on_the_reminded_local_date(timezone):
+    # The reminder run reads the local date at the start of the slot
+    day = datetime.date(2026, 1, 1)
+    while day.year == 2026:
+        for local_hour in (0, 1, 2, 12, 23):
+            start = scheduling.reminder_time(timezone, local_hour, day)
+            assert scheduling.local_date(start, timezone) == day, (day, local_hour)
+        day += datetime.timedelta(days=7) if day.month not in (3, 4, 10, 11) else datetime.timedelta(days=1)
+
+
+def test_next_reminder_slot():
+    # 08:30 in New York the day before DST starts: today's 09:00 reminder is still ahead
+    assert scheduling.next_reminder_slot("America/New_York", 9, utc(2026, 3, 7, 13, 30)) == 14
+    # Once it fired, the next one is tomorrow's, an hour earlier in UTC
+    assert scheduling.next_reminder_slot("America/New_York", 9, utc(2026, 3, 7, 14)) == 13
+    # 00:15 in Kolkata, the midnight reminder fires at 00:30 local
+    assert scheduling.next_reminder_slot("Asia/Kolkata", 0, utc(2026, 10, 17, 18, 45)) == 19
+    assert scheduling.next_reminder_slot("Asia/Kolkata", 0, utc(2026, 10, 17, 19)) == 19
+
+
+def test_following_reminder_slot():
+    assert scheduling.following_reminder_slot("America/New_York", 9, utc(2026, 3, 7, 14)) == 13
+    assert scheduling.following_reminder_slot("Europe/London", 9, utc(2026, 10, 24, 8)) == 9
+    assert scheduling.following_reminder_slot("Asia/Kolkata", 0, utc(2026, 10, 17, 19)) == 19
+
+
+def test_is_valid_timezone():
+    assert scheduling.is_valid_timezone("Asia/Kolkata")
+    assert not scheduling.is_valid_timezone("Mars/Olympus_Mons")
+    assert not scheduling.is_valid_timezone("../etc/passwd")